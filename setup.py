@@ -31,6 +31,7 @@ setup(name='wordpressupdater',
       entry_points={
          'console_scripts': [
             'wpupdater = wordpressupdater:run',
+            'wpupdater-coordinator = wordpressupdater:run_coordinator',
          ],
       },
       classifiers=[
@@ -0,0 +1,181 @@
+"""WPUpdaterDaemon event handling, driven without the serve() loop.
+
+Sites are directories with a wp-config.php; the stub wp-cli reports the
+contents of wp-includes/version.php as the core version.
+"""
+import os
+import socket
+import stat
+
+import pytest
+
+import wordpressupdater
+
+Inotify = wordpressupdater.Inotify
+
+STUB_WPCLI = r'''#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in --path=*) site="${arg#--path=}" ;; esac
+done
+case "$*" in
+    "cli version") echo "WP-CLI 2.8.1" ;;
+    *"core version") cat "$site/wp-includes/version.php" 2>/dev/null || exit 1 ;;
+    *"option get"*) echo "stub" ;;
+    *) exit 1 ;;
+esac
+'''
+
+
+def make_site(path, version='6.4.2'):
+    os.makedirs(os.path.join(path, 'wp-includes'), exist_ok=True)
+    with open(os.path.join(path, 'wp-includes', 'version.php'), 'w') as f:
+        f.write(version + '\n')
+    with open(os.path.join(path, 'wp-config.php'), 'w') as f:
+        f.write('<?php\n')
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'www'
+    make_site(str(root / 'one'))
+    return(str(root))
+
+
+@pytest.fixture
+def daemon(tmp_path, root):
+    stub = tmp_path / 'wp'
+    stub.write_text(STUB_WPCLI)
+    stub.chmod(stub.stat().st_mode | stat.S_IXUSR)
+    dowp = wordpressupdater.DO_WP_Maintain(configpaths=[root],
+                                           explicit_path=True,
+                                           allow_root=True,
+                                           exec_timeout=30,
+                                           path_to_wpcli=str(stub))
+    d = wordpressupdater.WPUpdaterDaemon(dowp, None,
+                                         str(tmp_path / 'sock'),
+                                         new_site_delay=0, settle=0)
+    d.sync_watches()
+    yield d
+    if d.server is not None:
+        d.server.shutdown()
+        d.server.server_close()
+    if d.inotify is not None:
+        d.inotify.close()
+
+
+def settle(d):
+    # Deliver what the kernel queued, then act on it
+    for event in d.inotify.read_events(0.2):
+        d.handle_event(*event)
+    d.process_dirty()
+
+
+def test_queue_overflow_triggers_rescan(daemon):
+    # The kernel reports overflow with wd -1; feed such a record through
+    # read_events from a pipe standing in for the inotify fd.
+    rfd, wfd = os.pipe()
+    real_fd, daemon.inotify.fd = daemon.inotify.fd, rfd
+    try:
+        os.write(wfd, Inotify._EVENT.pack(-1, Inotify.IN_Q_OVERFLOW, 0, 0))
+        daemon.next_rescan = float('inf')
+        for event in daemon.inotify.read_events(1.0):
+            daemon.handle_event(*event)
+    finally:
+        daemon.inotify.fd = real_fd
+        os.close(rfd)
+        os.close(wfd)
+    assert daemon.next_rescan != float('inf')
+
+
+def test_watches_version_file_only(daemon, root):
+    site = os.path.join(root, 'one')
+    assert os.path.join(site, 'wp-includes', 'version.php') in daemon.inotify.paths
+    assert os.path.join(site, 'wp-includes') not in daemon.inotify.paths
+
+
+def test_core_update_reprobes(daemon, root):
+    site = os.path.join(root, 'one')
+    with open(daemon.version_file(site), 'w') as f:
+        f.write('6.5\n')
+    settle(daemon)
+    assert daemon.dowp.wp_list.get(site).version == '6.5'
+
+
+def test_new_and_removed_site(daemon, root):
+    two = os.path.join(root, 'two')
+    make_site(two)
+    settle(daemon)
+    assert two in daemon.dowp.wp_list
+    assert two in daemon.pending_sites
+    os.unlink(os.path.join(two, 'wp-config.php'))
+    settle(daemon)
+    assert two not in daemon.dowp.wp_list
+    assert two not in daemon.pending_sites
+
+
+def test_site_in_new_subdirectory(daemon, root):
+    # Created empty first, so the DocumentRoot rescan finds nothing; the
+    # install is only found through the candidate watch.
+    acme = os.path.join(root, 'clients', 'acme')
+    os.makedirs(acme)
+    settle(daemon)
+    assert acme in daemon.candidates
+    make_site(acme)
+    settle(daemon)
+    assert acme in daemon.dowp.wp_list
+    assert acme not in daemon.candidates
+
+
+def test_candidate_depth(daemon, root):
+    os.makedirs(os.path.join(root, 'a', 'b', 'c'))
+    settle(daemon)
+    assert sorted(daemon.candidates) == [os.path.join(root, 'a'),
+                                         os.path.join(root, 'a', 'b')]
+
+
+def test_expired_candidates_are_dropped(daemon, root):
+    os.makedirs(os.path.join(root, 'a'))
+    settle(daemon)
+    daemon.candidates[os.path.join(root, 'a')] = (1, 0)
+    daemon.sync_watches()
+    assert daemon.candidates == {}
+    assert os.path.join(root, 'a') not in daemon.inotify.paths
+
+
+def test_fake_events(daemon, root):
+    site = os.path.join(root, 'one')
+    daemon.handle_event(root, Inotify.IN_CREATE | Inotify.IN_ISDIR, 'new')
+    assert root in daemon.dirty_roots
+    daemon.handle_event(site, Inotify.IN_CLOSE_WRITE, 'wp-config.php')
+    daemon.handle_event(site, Inotify.IN_CLOSE_WRITE, 'index.php')
+    assert list(daemon.dirty_installs) == [site]
+    daemon.dirty_installs = {}
+    daemon.handle_event(daemon.version_file(site), Inotify.IN_CLOSE_WRITE, '')
+    assert list(daemon.dirty_installs) == [site]
+    daemon.handle_event(None, Inotify.IN_IGNORED, '')
+
+
+def test_keeps_live_socket(daemon):
+    daemon.start_server()
+    other = wordpressupdater.WPUpdaterDaemon(daemon.dowp, None,
+                                             daemon.socket_path)
+    other.inotify.close()
+    with pytest.raises(RuntimeError):
+        other.start_server()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(daemon.socket_path)
+    client.sendall(b'status\n')
+    assert b'"sites": 1' in client.makefile('rb').readline()
+    client.close()
+
+
+def test_replaces_stale_socket(daemon):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(daemon.socket_path)
+    stale.close()
+    daemon.start_server()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(daemon.socket_path)
+    client.sendall(b'status\n')
+    assert b'"sites": 1' in client.makefile('rb').readline()
+    client.close()
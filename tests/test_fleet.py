@@ -0,0 +1,231 @@
+"""Coordinator/agent runs against several agents on localhost.
+
+Each agent is a real WPUpdaterAgent on an ephemeral port, backed by a stub
+wp-cli script. The stub logs when every "core update" starts and ends, so
+the tests can check the concurrency the coordinator actually reached.
+"""
+import http.client
+import os
+import stat
+import threading
+
+import pytest
+
+import wordpressupdater
+
+SECRET = b'0123456789abcdef0123456789abcdef'
+
+STUB_WPCLI = r'''#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in --path=*) site="${arg#--path=}" ;; esac
+done
+case "$*" in
+    "cli version") echo "WP-CLI 2.8.1" ;;
+    *"core version") echo "6.4.2" ;;
+    *"option get"*) echo "stub" ;;
+    *"core update") echo "start $(date +%s.%N) $site" >> "{log}"
+                    sleep {delay}
+                    echo "end $(date +%s.%N) $site" >> "{log}" ;;
+    *"core update-db") ;;
+    *) exit 1 ;;
+esac
+'''
+
+
+def write_stub(tmp_path, delay):
+    log = tmp_path / 'wpcli.log'
+    stub = tmp_path / 'wp'
+    stub.write_text(STUB_WPCLI.replace('{log}', str(log)).replace('{delay}', str(delay)))
+    stub.chmod(stub.stat().st_mode | stat.S_IXUSR)
+    return(stub, log)
+
+
+def make_sites(root, count):
+    for n in range(count):
+        site = root / 'site{}'.format(n)
+        site.mkdir(parents=True)
+        (site / 'wp-config.php').write_text("<?php\n")
+    return(root)
+
+
+def read_log(log):
+    # [(time, 'start' or 'end', site)] sorted by time
+    events = []
+    for line in log.read_text().splitlines():
+        kind, when, site = line.split(' ', 2)
+        events.append((float(when), kind, site))
+    return(sorted(events))
+
+
+def started_before_first_end(events):
+    # How full the fleet got before the first site finished
+    for n, (_, kind, _) in enumerate(events):
+        if kind == 'end':
+            return(n)
+    return(len(events))
+
+
+def max_concurrency(events):
+    current = peak = 0
+    for _, kind, _ in events:
+        current += 1 if kind == 'start' else -1
+        peak = max(peak, current)
+    return(peak)
+
+
+@pytest.fixture
+def fleet(tmp_path):
+    # Starts agents on demand:
+    # fleet(count, sites_per_agent, tags, delay, allow_run)
+    servers = []
+
+    def start(count, sites, tags=None, delay=0.3, allow_run=False):
+        stub, log = write_stub(tmp_path, delay)
+        addresses = []
+        for n in range(count):
+            root = make_sites(tmp_path / 'agent{}'.format(n), sites)
+            dowp = wordpressupdater.DO_WP_Maintain(configpaths=[str(root)],
+                                                   explicit_path=True,
+                                                   allow_root=True,
+                                                   exec_timeout=30,
+                                                   path_to_wpcli=str(stub))
+            agent_tags = tags[n] if tags is not None else None
+            agent = wordpressupdater.WPUpdaterAgent(dowp, '127.0.0.1:0',
+                                                    SECRET, tags=agent_tags,
+                                                    allow_run=allow_run)
+            server = agent.make_server()
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+            addresses.append('127.0.0.1:{}'.format(server.server_address[1]))
+        return(addresses, log)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_reaches_fleet_wide_limit(fleet):
+    agents, log = fleet(5, 4)
+    coordinator = wordpressupdater.FleetCoordinator(agents, SECRET, ['core'],
+                                                    max_parallel=6,
+                                                    per_agent=2)
+    report = coordinator.run()
+    assert report['summary'] == {'agents': 5,
+                                 'agents_unreachable': 0,
+                                 'commands': 20,
+                                 'failures': 0}
+    events = read_log(log)
+    assert started_before_first_end(events) == 6
+    assert max_concurrency(events) == 6
+
+
+def test_per_agent_limit(fleet):
+    agents, log = fleet(2, 4)
+    coordinator = wordpressupdater.FleetCoordinator(agents, SECRET, ['core'],
+                                                    max_parallel=10,
+                                                    per_agent=1)
+    coordinator.run()
+    assert max_concurrency(read_log(log)) == 2
+
+
+def test_task_limit(fleet):
+    agents, log = fleet(3, 2, delay=0.1)
+    coordinator = wordpressupdater.FleetCoordinator(agents, SECRET,
+                                                    ['core', 'db'],
+                                                    max_parallel=10,
+                                                    per_agent=2,
+                                                    task_limits={'core': 1})
+    report = coordinator.run()
+    assert report['summary']['commands'] == 12
+    assert report['summary']['failures'] == 0
+    assert max_concurrency(read_log(log)) == 1
+
+
+def test_stagger_by_tag(fleet):
+    agents, log = fleet(3, 2, tags=[['web'], ['canary'], ['web']], delay=0.1)
+    coordinator = wordpressupdater.FleetCoordinator(agents, SECRET, ['core'],
+                                                    stagger=['canary'])
+    coordinator.run()
+    events = read_log(log)
+    canary = [when for when, _, site in events if '/agent1/' in site]
+    others = [when for when, _, site in events if '/agent1/' not in site]
+    assert len(canary) == 4 and len(others) == 8
+    assert max(canary) < min(others)
+
+
+def test_rejects_wrong_secret(fleet):
+    agents, log = fleet(2, 1)
+    coordinator = wordpressupdater.FleetCoordinator(agents, b'x' * 32, ['core'])
+    report = coordinator.run()
+    assert report['summary']['agents_unreachable'] == 2
+    assert report['summary']['commands'] == 0
+    assert not os.path.exists(str(log))
+
+
+def raw_request(agent, length):
+    host, port = agent.split(':')
+    conn = http.client.HTTPConnection(host, int(port), timeout=10)
+    conn.putrequest('POST', '/run')
+    conn.putheader('Content-Length', length)
+    conn.endheaders()
+    response = conn.getresponse()
+    conn.close()
+    return(response.status)
+
+
+def test_rejects_bad_content_length(fleet):
+    agents, log = fleet(1, 1)
+    # Answered before any body is read or the signature is checked
+    assert raw_request(agents[0], 'abc') == 400
+    assert raw_request(agents[0], '-5') == 400
+    assert raw_request(agents[0], str(2 * 1024 * 1024)) == 413
+    assert raw_request(agents[0], '0') == 401
+
+
+def test_custom_needs_command_list(fleet):
+    agents, log = fleet(1, 1, allow_run=True)
+    coordinator = wordpressupdater.FleetCoordinator(agents, SECRET, ['custom'])
+    agent = coordinator.agents[0]
+    path = coordinator.request(agent, 'GET', '/sites')['sites'][0]['path']
+    for cmds in (None, 'core update', [], ['core version', 3]):
+        with pytest.raises(RuntimeError, match='HTTP 400'):
+            coordinator.request(agent, 'POST', '/run',
+                                {'task': 'custom', 'path': path, 'cmds': cmds})
+    reply = coordinator.request(agent, 'POST', '/run',
+                                {'task': 'custom', 'path': path,
+                                 'cmds': ['core version']})
+    assert [r['status'] for r in reply['results']] == [0]
+
+
+def test_limits_must_be_positive():
+    with pytest.raises(ValueError):
+        wordpressupdater.FleetCoordinator(['127.0.0.1:1'], SECRET, ['core'],
+                                          max_parallel=0)
+    with pytest.raises(ValueError):
+        wordpressupdater.FleetCoordinator(['127.0.0.1:1'], SECRET, ['core'],
+                                          per_agent=0)
+    assert wordpressupdater.positive_int('3') == 3
+    for arg in ('0', '-1', 'x'):
+        with pytest.raises(wordpressupdater.argparse.ArgumentTypeError):
+            wordpressupdater.positive_int(arg)
+
+
+def test_agent_saves_state_once_per_interval(tmp_path):
+    stub, log = write_stub(tmp_path, 0)
+    root = make_sites(tmp_path / 'agent', 3)
+    dowp = wordpressupdater.DO_WP_Maintain(configpaths=[str(root)],
+                                           explicit_path=True,
+                                           allow_root=True,
+                                           exec_timeout=30,
+                                           path_to_wpcli=str(stub))
+    saves = []
+    dowp.save_state = lambda: saves.append(1)
+    agent = wordpressupdater.WPUpdaterAgent(dowp, '127.0.0.1:0', SECRET)
+    for site in dowp.wp_list:
+        body = '{{"task": "core", "path": "{}"}}'.format(site.path)
+        assert agent.handle('POST', '/run', body.encode('utf-8'))[0] == 200
+    assert saves == []
+    agent.flush()
+    agent.flush()
+    assert saves == [1]
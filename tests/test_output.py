@@ -0,0 +1,57 @@
+"""Output sinks for --run: --output-dir and --output-archive."""
+import gzip
+import os
+import zipfile
+
+import wordpressupdater
+
+
+def test_archive_captures_run_concurrently(tmp_path):
+    path = str(tmp_path / 'out.zip')
+    sink = wordpressupdater.ArchiveOutputSink(path)
+    # Both are open at once; neither waits for the other
+    one = sink.begin('/var/www/one', ['plugin', 'list'])
+    two = sink.begin('/var/www/two', ['plugin', 'list'])
+    one.write('stdout', b'one ')
+    two.write('stdout', b'two')
+    one.write('stderr', b'warning')
+    one.write('stdout', b'done')
+    two.end()
+    one.end()
+    sink.close()
+    with zipfile.ZipFile(path) as z:
+        names = dict((name.split('/')[0][:len('var-www-one')], name)
+                     for name in z.namelist() if name.endswith('.out'))
+        assert z.read(names['var-www-one']) == b'one done'
+        assert z.read(names['var-www-two']) == b'two'
+        errs = [name for name in z.namelist() if name.endswith('.err')]
+        assert len(errs) == 1 and z.read(errs[0]) == b'warning'
+
+
+def test_archive_close_after_abandoned_capture(tmp_path):
+    # A capture that never ends (e.g. Popen failed) must not block close()
+    path = str(tmp_path / 'out.zip')
+    sink = wordpressupdater.ArchiveOutputSink(path)
+    sink.begin('/var/www/one', ['core', 'version']).write('stdout', b'x')
+    capture = sink.begin('/var/www/one', ['core', 'version'])
+    capture.end()
+    sink.close()
+    with zipfile.ZipFile(path) as z:
+        assert [name.split('/')[1] for name in z.namelist()] == ['002-core-version.out']
+
+
+def test_directory_sink(tmp_path):
+    sink = wordpressupdater.DirectoryOutputSink(str(tmp_path), compress=True)
+    capture = sink.begin('/var/www/one', ['plugin', 'list'])
+    capture.write('stdout', b'akismet')
+    capture.end()
+    sitedir = os.path.join(str(tmp_path), wordpressupdater.output_site_name('/var/www/one'))
+    assert os.listdir(sitedir) == ['001-plugin-list.out.gz']
+    with gzip.open(os.path.join(sitedir, '001-plugin-list.out.gz')) as f:
+        assert f.read() == b'akismet'
+
+
+def test_site_names_are_unique():
+    name = wordpressupdater.output_site_name
+    assert name('/var/www/a-b') != name('/var/www/a/b')
+    assert name('/var/www/a-b').startswith('var-www-a-b-')
@@ -0,0 +1,91 @@
+"""SiteRegistry selection: --where, --with-plugin and --path-prefix."""
+import argparse
+import os
+
+import pytest
+
+import wordpressupdater
+from wordpressupdater import SiteRecord, parse_where
+
+
+@pytest.fixture
+def registry():
+    return(wordpressupdater.SiteRegistry([
+        SiteRecord('/var/www/a', '6.4.2', title='A', db_host='db1',
+                   plugins=['akismet']),
+        SiteRecord('/var/www/a/b', '6.5-RC1', db_host='db1',
+                   plugins=['akismet', 'woocommerce']),
+        SiteRecord('/var/www/a-b', '6.5', db_host='db2',
+                   plugins=['woocommerce']),
+        SiteRecord('/var/www/ab', '6.3', db_host='db2'),
+        SiteRecord('/srv/other', '6.5.1'),
+    ]))
+
+
+def paths(records):
+    return([record.path for record in records])
+
+
+def test_parse_where():
+    assert parse_where('version<6.4') == ('version', '<', '6.4')
+    assert parse_where(' db_host = db1:3306 ') == ('db_host', '=', 'db1:3306')
+    assert parse_where('title!=My Blog') == ('title', '!=', 'My Blog')
+    assert parse_where('version>=6.5-RC1') == ('version', '>=', '6.5-RC1')
+    for expr in ('version', 'plugins=akismet', 'version~6'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_where(expr)
+
+
+def test_version_key():
+    assert wordpressupdater.version_key('6.4') == wordpressupdater.version_key('6.4.0')
+    order = ['6.4.2', '6.5-alpha-57000', '6.5-beta2', '6.5-RC1', '6.5-RC2',
+             '6.5', '6.5.1', '6.10']
+    assert sorted(order, key=wordpressupdater.version_key) == order
+
+
+def test_with_prefix_whole_components(registry):
+    assert registry.with_prefix('/var/www/a') == {'/var/www/a', '/var/www/a/b'}
+    assert registry.with_prefix('/var/www/a/') == {'/var/www/a', '/var/www/a/b'}
+    assert registry.with_prefix('/var/www/a-b') == {'/var/www/a-b'}
+    assert registry.with_prefix('/var/www/a/b/c') == set()
+    assert len(registry.with_prefix('/')) == 5
+
+
+def test_with_prefix_relative(registry, monkeypatch):
+    monkeypatch.chdir('/var')
+    assert registry.with_prefix('www/a') == {'/var/www/a', '/var/www/a/b'}
+    assert registry.with_prefix('./www/../www/ab') == {'/var/www/ab'}
+
+
+def test_select_where(registry):
+    assert paths(registry.select(where=[parse_where('version<6.5')])) == \
+        ['/var/www/a', '/var/www/a/b', '/var/www/ab']
+    assert paths(registry.select(where=[parse_where('version=6.5')])) == \
+        ['/var/www/a-b']
+    assert paths(registry.select(where=[parse_where('db_host=db1'),
+                                        parse_where('title=A')])) == ['/var/www/a']
+    assert registry.select(where=[parse_where('db_host=db3')]) == []
+
+
+def test_select_combined(registry):
+    selected = registry.select(where=[parse_where('version>=6.4')],
+                               plugins=['woocommerce'],
+                               path_prefixes=['/var/www/a'])
+    assert paths(selected) == ['/var/www/a/b']
+    assert paths(registry.select(plugins=['akismet', 'woocommerce'])) == ['/var/www/a/b']
+    assert paths(registry.select(path_prefixes=['/srv', '/var/www/ab'])) == \
+        ['/srv/other', '/var/www/ab']
+    assert len(registry.select()) == 5
+
+
+def test_select_after_remove(registry):
+    registry.remove('/var/www/a/b')
+    assert paths(registry.select(plugins=['woocommerce'])) == ['/var/www/a-b']
+    assert paths(registry.select(path_prefixes=['/var/www/a'])) == ['/var/www/a']
+
+
+def test_save_and_load(registry, tmp_path):
+    path = os.path.join(str(tmp_path), 'sites.json')
+    registry.save(path)
+    loaded = wordpressupdater.SiteRegistry.load(path)
+    assert [r.as_dict() for r in loaded] == [r.as_dict() for r in registry]
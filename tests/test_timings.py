@@ -0,0 +1,108 @@
+"""CommandTimings: learned timeouts from recorded wp-cli durations."""
+import wordpressupdater
+
+SITE = '/var/www/site'
+VERSION = ['core', 'version']
+UPDATE = ['core', 'update']
+
+
+def timings(tmp_path, **kwargs):
+    return(wordpressupdater.CommandTimings(str(tmp_path / 'timings.json'),
+                                           **kwargs))
+
+
+def test_default_without_history(tmp_path):
+    t = timings(tmp_path, default=300)
+    assert t.timeout_for(SITE, VERSION) == 300
+
+
+def test_default_until_min_samples(tmp_path):
+    t = timings(tmp_path, default=300, min_samples=5)
+    for _ in range(4):
+        t.record(SITE, VERSION, 20.0)
+    assert t.timeout_for(SITE, VERSION) == 300
+    t.record(SITE, VERSION, 20.0)
+    assert t.timeout_for(SITE, VERSION) == 60
+
+
+def test_percentile_rank(tmp_path):
+    # 95th percentile of 1..20 is the 19th value
+    t = timings(tmp_path, floor=1, factor=2.0)
+    for n in range(1, 21):
+        t.record(SITE, VERSION, float(n))
+    assert t.timeout_for(SITE, VERSION) == 38
+
+
+def test_floor_and_ceiling(tmp_path):
+    t = timings(tmp_path, floor=30, ceiling=100)
+    for _ in range(5):
+        t.record(SITE, VERSION, 1.0)
+        t.record(SITE, ['option', 'get', 'siteurl'], 500.0)
+    assert t.timeout_for(SITE, VERSION) == 30
+    assert t.timeout_for(SITE, ['option', 'get', 'blogname']) == 100
+
+
+def test_timed_out_runs_are_not_samples(tmp_path):
+    t = timings(tmp_path, default=300, floor=1)
+    for _ in range(5):
+        t.record(SITE, VERSION, 10.0)
+    t.record(SITE, VERSION, 30.0, timed_out=True)
+    t.record(SITE, VERSION, 30.0, timed_out=True)
+    assert t.timeout_for(SITE, VERSION) == 30
+
+
+def test_timed_out_only_history(tmp_path):
+    # One doubled step, then it stays there
+    t = timings(tmp_path, default=300, ceiling=3600)
+    t.record(SITE, VERSION, 300.0, timed_out=True)
+    assert t.timeout_for(SITE, VERSION) == 600
+    t.record(SITE, VERSION, 600.0, timed_out=True)
+    assert t.timeout_for(SITE, VERSION) == 600
+    t = timings(tmp_path, default=300, ceiling=400)
+    t.record(SITE, VERSION, 300.0, timed_out=True)
+    assert t.timeout_for(SITE, VERSION) == 400
+
+
+def test_updates_never_below_default(tmp_path):
+    t = timings(tmp_path, default=300, floor=30)
+    for _ in range(20):
+        t.record(SITE, UPDATE, 2.0)
+        t.record(SITE, ['plugin', 'update', 'akismet'], 2.0)
+    assert t.timeout_for(SITE, UPDATE) == 300
+    assert t.timeout_for(SITE, ['plugin', 'update', 'woocommerce']) == 300
+
+
+def test_updates_can_grow(tmp_path):
+    t = timings(tmp_path, default=300, ceiling=3600)
+    for _ in range(5):
+        t.record(SITE, ['core', 'update-db'], 400.0)
+    assert t.timeout_for(SITE, ['core', 'update-db']) == 1200
+
+
+def test_explicit_read_only(tmp_path):
+    # --run commands are never treated as read-only
+    t = timings(tmp_path, default=300, floor=30)
+    for _ in range(5):
+        t.record(SITE, VERSION, 1.0)
+    assert t.timeout_for(SITE, VERSION, read_only=False) == 300
+    assert t.timeout_for(SITE, UPDATE, read_only=True) == 300
+
+
+def test_overruns(tmp_path):
+    t = timings(tmp_path)
+    for timed_out in (True, False, True, True):
+        t.record(SITE, UPDATE, 1.0, timed_out=timed_out)
+    for timed_out in (True, True, False):
+        t.record('/var/www/other', UPDATE, 1.0, timed_out=timed_out)
+    assert t.overruns() == [(SITE, 'core update', 3)]
+    # Only the last window runs count
+    for _ in range(10):
+        t.record(SITE, UPDATE, 1.0)
+    assert t.overruns() == []
+
+
+def test_save_and_load(tmp_path):
+    t = timings(tmp_path)
+    t.record(SITE, UPDATE, 1.5, timed_out=True)
+    t.save()
+    assert timings(tmp_path).entries == t.entries
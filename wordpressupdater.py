@@ -1,16 +1,42 @@
 #!/usr/bin/env python3
+import io
 import os
+import re
+import csv
 import sys
+import hmac
 import json
+import gzip
+import math
+import time
+import shlex
+import bisect
+import operator
+import socket
+import hashlib
+import ctypes
+import ctypes.util
+import functools
+import contextlib
+import queue
+import select
+import zipfile
+import tempfile
+import selectors
 import shutil
+import signal
+import struct
 import requests
+import atexit
 import argparse
+import threading
 import subprocess
+import http.server
+import socketserver
 from pathlib import Path
 from apacheconfig import make_loader
-from pprint import pprint
 
-__version__ = '0.5.16'
+__version__ = '0.6.0'
 
 
 def printerr(x):
@@ -21,6 +47,642 @@ def pprinterr(x):
     from pprint import pprint
     pprint(x, stream=sys.stderr)
 
+# Streaming capture of custom command output: chunks are handed to an
+# output sink as they arrive and only the last OUTPUT_TAIL bytes of each
+# stream are kept in memory, for error messages.
+OUTPUT_CHUNK = 65536
+OUTPUT_TAIL = 65536
+
+
+def output_slug(text, maxlen=60):
+    slug = re.sub(r'[^A-Za-z0-9._-]+', '-', text).strip('-')
+    return(slug[:maxlen] or 'root')
+
+
+def output_site_name(site):
+    # Readable, but unique per site: /var/www/a-b and /var/www/a/b both
+    # slug to var-www-a-b, so a short hash of the real path is appended.
+    digest = hashlib.sha1(site.encode('utf-8', 'surrogateescape')).hexdigest()
+    return('{}-{}'.format(output_slug(site, maxlen=180), digest[:8]))
+
+
+class ConsoleOutputSink():
+    # Default sink: stdout goes to stderr when verbose, like before,
+    # otherwise it is discarded.
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def begin(self, site, args):
+        return(self)
+
+    def write(self, stream, chunk):
+        if self.verbose and stream == 'stdout':
+            sys.stderr.buffer.write(chunk)
+            sys.stderr.buffer.flush()
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DirectoryOutputSink():
+    # DIR/<site>-<hash>/<NNN>-<command>.out (and .err if there is stderr),
+    # gzip-compressed when compress is set.
+    def __init__(self, directory, compress=False):
+        self.directory = directory
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.counters = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self, site, args):
+        sitedir = os.path.join(self.directory, output_site_name(site))
+        with self.lock:
+            n = self.counters.get(site, 0) + 1
+            self.counters[site] = n
+        os.makedirs(sitedir, exist_ok=True)
+        base = os.path.join(sitedir, '{:03d}-{}'.format(n, output_slug(' '.join(args))))
+        return(DirectoryOutputCapture(base, self.compress))
+
+    def close(self):
+        pass
+
+
+class DirectoryOutputCapture():
+    def __init__(self, base, compress):
+        self.base = base
+        self.compress = compress
+        self.files = {}
+
+    def write(self, stream, chunk):
+        f = self.files.get(stream)
+        if f is None:  # Created lazily; no empty .err files
+            name = '{}.{}'.format(self.base, 'out' if stream == 'stdout' else 'err')
+            if self.compress:
+                f = gzip.open(name + '.gz', 'wb')
+            else:
+                f = open(name, 'wb')
+            self.files[stream] = f
+        f.write(chunk)
+
+    def end(self):
+        for f in self.files.values():
+            f.close()
+
+
+class ArchiveOutputSink():
+    # Single deflate-compressed zip archive. Zip entries can only be
+    # written one at a time, so each capture spools its output (to disk
+    # past 1 MiB) while the command runs, and holds the lock only to copy
+    # it into the archive when it ends.
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def begin(self, site, args):
+        with self.lock:
+            n = self.counters.get(site, 0) + 1
+            self.counters[site] = n
+        base = '{}/{:03d}-{}'.format(output_site_name(site), n,
+                                     output_slug(' '.join(args)))
+        return(ArchiveOutputCapture(self, base))
+
+    def close(self):
+        with self.lock:
+            self.zip.close()
+
+
+class ArchiveOutputCapture():
+    def __init__(self, sink, base):
+        self.sink = sink
+        self.base = base
+        self.files = {}
+
+    def write(self, stream, chunk):
+        f = self.files.get(stream)
+        if f is None:
+            f = tempfile.SpooledTemporaryFile(max_size=1048576)
+            self.files[stream] = f
+        f.write(chunk)
+
+    def end(self):
+        # .out is always written, .err only if there was stderr
+        try:
+            with self.sink.lock:
+                for stream, ext in (('stdout', '.out'), ('stderr', '.err')):
+                    f = self.files.get(stream)
+                    if f is None and stream == 'stderr':
+                        continue
+                    with self.sink.zip.open(self.base + ext, 'w',
+                                            force_zip64=True) as entry:
+                        if f is not None:
+                            f.seek(0)
+                            shutil.copyfileobj(f, entry, OUTPUT_CHUNK)
+        finally:
+            for f in self.files.values():
+                f.close()
+
+
+class Tracer():
+    # Records spans as Chrome trace-event "complete" events, viewable in
+    # Perfetto (ui.perfetto.dev) or chrome://tracing. One timeline row
+    # per thread, so concurrency and stragglers are visible.
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+
+    def _now(self):
+        return((time.perf_counter() - self.origin) * 1e6)  # microseconds
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # args may be updated by the caller while the span is open
+        thread = threading.current_thread()
+        start = self._now()
+        try:
+            yield args
+        finally:
+            event = {'name': name,
+                     'cat': 'wpupdater',
+                     'ph': 'X',
+                     'ts': round(start, 1),
+                     'dur': round(self._now() - start, 1),
+                     'pid': self.pid,
+                     'tid': thread.ident,
+                     'args': args, }
+            with self.lock:
+                self.threads[thread.ident] = thread.name
+                self.events.append(event)
+
+    def save(self):
+        with self.lock:
+            meta = [{'name': 'thread_name',
+                     'ph': 'M',
+                     'pid': self.pid,
+                     'tid': tid,
+                     'args': {'name': name}, }
+                    for tid, name in self.threads.items()]
+            meta.append({'name': 'process_name',
+                         'ph': 'M',
+                         'pid': self.pid,
+                         'args': {'name': 'wpupdater'}, })
+            data = {'traceEvents': meta + self.events,
+                    'displayTimeUnit': 'ms', }
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(data, f, default=str)
+        except OSError as exc:
+            printerr('Cannot write trace {}: {}'.format(self.path, exc))
+
+
+class NullTracer():
+    # Used when --trace is not given
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        yield args
+
+    def save(self):
+        pass
+
+
+def traced(method):
+    # Wraps a DO_WP_Maintain method in a span named after it
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.tracer.span(method.__name__):
+            return(method(self, *args, **kwargs))
+    return(wrapper)
+
+
+class SamplingProfiler():
+    # Samples the Python stacks of all other threads every interval
+    # seconds and writes them as folded stacks ("a;b;c count"), the input
+    # format of flamegraph.pl, speedscope and friends.
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.samples = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._sample,
+                                       name='wpupdater-profiler',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for tid, frame in sys._current_frames().items():
+                if tid == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name,
+                                                     os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        try:
+            with open(self.path, 'w') as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write('{} {}\n'.format(stack, count))
+        except OSError as exc:
+            printerr('Cannot write profile {}: {}'.format(self.path, exc))
+
+
+def profile_path(trace_path):
+    # run.json -> run.folded, next to the trace
+    base, ext = os.path.splitext(trace_path)
+    if ext.lower() != '.json':
+        base = trace_path
+    return(base + '.folded')
+
+
+class CommandTimings():
+    # Persists wp-cli durations per (site, command type) between runs and
+    # derives timeouts from them: the given percentile of recent durations
+    # times a safety factor, clamped to [floor, ceiling]. Only runs that
+    # completed count, so a probe that keeps hanging stays on its learned
+    # limit and shows up in overruns() instead. Until a command has
+    # min_samples completed runs the default timeout applies; a command
+    # that has only ever timed out gets one bounded step, default x2.
+    # Learned limits only shorten read-only commands: an update that is
+    # usually a 2s no-op must not be killed halfway through a real
+    # download, so anything that changes a site gets at least the default.
+    READ_ONLY = frozenset(['core version',
+                           'core is-installed',
+                           'option get',
+                           'plugin list',
+                           'theme list'])
+
+    def __init__(self,
+                 path,
+                 default=300,
+                 floor=30,
+                 ceiling=3600,
+                 percentile=95,
+                 factor=3.0,
+                 min_samples=5,
+                 keep=50):
+        self.path = path
+        self.default = default
+        self.floor = floor
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.factor = factor
+        self.min_samples = min_samples
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.load()
+
+    @staticmethod
+    def command_type(args):
+        # "plugin update akismet" and "plugin update jetpack" share stats
+        words = [arg for arg in args if not arg.startswith('-')]
+        return(' '.join(words[:2]))
+
+    def key(self, site, args):
+        return('{}\t{}'.format(site, self.command_type(args)))
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f).get('entries', {})
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as exc:
+            printerr('Ignoring unreadable timing stats {}: {}'.format(self.path, exc))
+            self.entries = {}
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with self.lock:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(tmp, 'w') as f:
+                    json.dump({'version': 1, 'entries': self.entries}, f)
+                os.replace(tmp, self.path)
+            except OSError as exc:
+                printerr('Cannot save timing stats {}: {}'.format(self.path, exc))
+
+    def timeout_for(self, site, args, read_only=None):
+        # read_only=None decides from the command type; callers running
+        # arbitrary commands (--run) pass False.
+        if read_only is None:
+            read_only = self.command_type(args) in self.READ_ONLY
+        timeout = self.learned_timeout(site, args)
+        if not read_only:
+            timeout = max(timeout, self.default)
+        return(timeout)
+
+    def learned_timeout(self, site, args):
+        with self.lock:
+            entry = self.entries.get(self.key(site, args))
+            if entry is None:
+                return(self.default)
+            durations = sorted(d for d, t in zip(entry['durations'],
+                                                 entry['timeouts'])
+                               if not t)
+            timed_out = any(entry['timeouts'])
+        if len(durations) < self.min_samples:
+            if not durations and timed_out:
+                return(min(max(self.default * 2, self.floor), self.ceiling))
+            return(self.default)
+        rank = max(int(math.ceil(self.percentile / 100.0 * len(durations))) - 1, 0)
+        timeout = durations[rank] * self.factor
+        return(min(max(timeout, self.floor), self.ceiling))
+
+    def record(self, site, args, duration, timed_out=False):
+        with self.lock:
+            entry = self.entries.setdefault(self.key(site, args),
+                                            {'durations': [], 'timeouts': []})
+            entry['durations'].append(round(duration, 3))
+            entry['timeouts'].append(1 if timed_out else 0)
+            del entry['durations'][:-self.keep]
+            del entry['timeouts'][:-self.keep]
+
+    def overruns(self, window=10, min_count=3):
+        # (site, command type, count) for commands that timed out at least
+        # min_count times within their last window runs
+        found = []
+        with self.lock:
+            for key, entry in self.entries.items():
+                count = sum(entry['timeouts'][-window:])
+                if count >= min_count:
+                    site, cmdtype = key.split('\t', 1)
+                    found.append((site, cmdtype, count))
+        return(sorted(found))
+
+
+def default_timing_db():
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return(os.path.join(cachedir, 'wpupdater', 'timings.json'))
+
+
+PRERELEASE_STAGES = {'alpha': 0, 'beta': 1, 'rc': 2}
+
+
+def version_key(version):
+    # '6.4.2' -> (6, 4, 2, 0, 3, 0); '6.5-RC1' -> (6, 5, 0, 0, 2, 1).
+    # Padded so that '6.4' and '6.4.0' compare equal; the last two items
+    # sort alpha < beta < RC < the release itself.
+    number, _, suffix = str(version).partition('-')
+    parts = []
+    for part in number.split('.'):
+        if not part.isdigit():
+            break
+        parts.append(int(part))
+    stage = (3, 0)
+    m = re.match(r'(alpha|beta|rc)[-.]?(\d*)', suffix.lower())
+    if m is not None:
+        stage = (PRERELEASE_STAGES[m.group(1)], int(m.group(2) or 0))
+    return(tuple(parts[:4] + [0] * (4 - len(parts))) + stage)
+
+
+WHERE_FIELDS = ('path', 'version', 'title', 'siteurl', 'db_host')
+WHERE_OPS = {'=': operator.eq,
+             '==': operator.eq,
+             '!=': operator.ne,
+             '<': operator.lt,
+             '<=': operator.le,
+             '>': operator.gt,
+             '>=': operator.ge, }
+
+
+def parse_where(expr):
+    # "version<6.4" -> ('version', '<', '6.4'); used as an argparse type
+    m = re.match(r'^\s*(\w+)\s*(==|!=|<=|>=|=|<|>)\s*(.*?)\s*$', expr)
+    if m is None or m.group(1) not in WHERE_FIELDS:
+        raise(argparse.ArgumentTypeError('expected FIELD OP VALUE with FIELD one of {}'.format(', '.join(WHERE_FIELDS))))
+    return(m.groups())
+
+
+def where_matches(field, actual, op, value):
+    if actual is None:
+        return(False)
+    if field == 'version':
+        return(WHERE_OPS[op](version_key(actual), version_key(value)))
+    return(WHERE_OPS[op](actual, value))
+
+
+class SiteRecord():
+    # One discovered wordpress installation. plugins holds the slugs of
+    # installed plugins, read from wp-content/plugins.
+    __slots__ = ('path', 'version', 'title', 'siteurl', 'db_host', 'plugins')
+
+    def __init__(self, path, version, title='', siteurl='', db_host=None,
+                 plugins=()):
+        self.path = path
+        self.version = version
+        self.title = title
+        self.siteurl = siteurl
+        self.db_host = db_host
+        self.plugins = tuple(plugins)
+
+    def as_dict(self):
+        d = dict((name, getattr(self, name)) for name in self.__slots__)
+        d['plugins'] = list(self.plugins)
+        return(d)
+
+    @classmethod
+    def from_dict(cls, d):
+        return(cls(d['path'], d['version'], d.get('title', ''),
+                   d.get('siteurl', ''), d.get('db_host'),
+                   d.get('plugins', ())))
+
+    def __repr__(self):
+        return('SiteRecord({!r}, version={!r})'.format(self.path, self.version))
+
+
+class SiteRegistry():
+    # Discovered sites indexed by path, DB host, WP version and plugin
+    # slug, so subsets can be selected without looking at every site.
+    # Iterates in path order. Agents and the daemon use it from several
+    # threads, so changes, reads of the indexes and saves hold self.lock.
+    def __init__(self, records=()):
+        self.lock = threading.RLock()
+        self.by_path = {}
+        self.by_db_host = {}
+        self.by_version = {}
+        self.by_plugin = {}
+        self._sorted = None
+        for record in records:
+            self.add(record)
+
+    @staticmethod
+    def _index(index, key, path):
+        index.setdefault(key, set()).add(path)
+
+    @staticmethod
+    def _unindex(index, key, path):
+        paths = index.get(key)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del index[key]
+
+    def add(self, record):
+        # Adds or replaces the record for record.path
+        with self.lock:
+            self.remove(record.path)
+            self.by_path[record.path] = record
+            self._index(self.by_db_host, record.db_host, record.path)
+            self._index(self.by_version, record.version, record.path)
+            for slug in record.plugins:
+                self._index(self.by_plugin, slug, record.path)
+            self._sorted = None
+
+    def remove(self, path):
+        with self.lock:
+            record = self.by_path.pop(path, None)
+            if record is None:
+                return(None)
+            self._unindex(self.by_db_host, record.db_host, path)
+            self._unindex(self.by_version, record.version, path)
+            for slug in record.plugins:
+                self._unindex(self.by_plugin, slug, path)
+            self._sorted = None
+            return(record)
+
+    def get(self, path):
+        return(self.by_path.get(path))
+
+    def paths(self):
+        # The returned list is replaced, never modified, on changes
+        with self.lock:
+            if self._sorted is None:
+                self._sorted = sorted(self.by_path)
+            return(self._sorted)
+
+    def __iter__(self):
+        with self.lock:
+            return(iter([self.by_path[path] for path in self.paths()]))
+
+    def __len__(self):
+        return(len(self.by_path))
+
+    def __contains__(self, path):
+        return(path in self.by_path)
+
+    def with_prefix(self, prefix):
+        # Whole path components only: /var/www/a matches /var/www/a and
+        # /var/www/a/b, not /var/www/ab. Candidates are found by bisecting
+        # the sorted paths on the plain string prefix. Site paths are
+        # absolute, so relative prefixes are taken from the current directory.
+        prefix = os.path.abspath(prefix)
+        below = prefix if prefix.endswith('/') else prefix + '/'
+        paths = self.paths()
+        start = bisect.bisect_left(paths, prefix)
+        found = set()
+        for path in paths[start:]:
+            if not path.startswith(prefix):
+                break
+            if path == prefix or path.startswith(below):
+                found.add(path)
+        return(found)
+
+    def select(self, where=(), plugins=(), path_prefixes=()):
+        # where: (field, op, value) tuples, all must match
+        # plugins: slugs that must all be installed
+        # path_prefixes: paths must be at or below any of them
+        with self.lock:
+            candidates = None
+            indexes = {'version': self.by_version, 'db_host': self.by_db_host}
+
+            def narrow(paths):
+                if candidates is None:
+                    return(set(paths))
+                return(candidates & paths)
+
+            for slug in plugins:
+                candidates = narrow(self.by_plugin.get(slug, set()))
+            if path_prefixes:
+                matched = set()
+                for prefix in path_prefixes:
+                    matched |= self.with_prefix(prefix)
+                candidates = narrow(matched)
+            rest = []
+            for field, op, value in where:
+                index = indexes.get(field)
+                if index is None:
+                    rest.append((field, op, value))
+                    continue
+                matched = set()
+                for key, paths in index.items():  # distinct values only
+                    if where_matches(field, key, op, value):
+                        matched |= paths
+                candidates = narrow(matched)
+            if candidates is None:
+                records = list(self)
+            else:
+                records = [self.by_path[path] for path in sorted(candidates)]
+            for field, op, value in rest:
+                records = [record for record in records
+                           if where_matches(field, getattr(record, field), op, value)]
+            return(records)
+
+    def save(self, path):
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                with open(tmp, 'w') as f:
+                    json.dump({'version': 1,
+                               'sites': [record.as_dict() for record in self]}, f)
+                os.replace(tmp, path)
+            except OSError as exc:
+                printerr('Cannot save site registry {}: {}'.format(path, exc))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return(cls(SiteRecord.from_dict(d) for d in data['sites']))
+
+
+def format_sites(records, fmt='table'):
+    columns = ('path', 'version', 'title', 'siteurl', 'db_host', 'plugins')
+    if fmt == 'json':
+        return(json.dumps([record.as_dict() for record in records], indent=2))
+    if fmt == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for record in records:
+            writer.writerow([record.path, record.version, record.title,
+                             record.siteurl, record.db_host or '',
+                             ';'.join(record.plugins)])
+        return(out.getvalue().rstrip('\n'))
+    rows = [('PATH', 'VERSION', 'TITLE', 'SITEURL', 'DB_HOST', 'PLUGINS')]
+    for record in records:
+        rows.append((record.path, record.version, record.title,
+                     record.siteurl, record.db_host or '-',
+                     str(len(record.plugins))))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return('\n'.join('  '.join(cell.ljust(width)
+                               for cell, width in zip(row, widths)).rstrip()
+                     for row in rows))
+
+
 class DO_WP_Maintain():
     def __init__(self,
                  configpaths=None,
@@ -33,10 +695,16 @@ class DO_WP_Maintain():
                  skip_plugins=None,
                  skip_themes=None,
                  exec_timeout=None,
-                 path_to_wpcli=None):
+                 path_to_wpcli=None,
+                 timings=None,
+                 output_sink=None,
+                 tracer=None,
+                 registry_path=None,
+                 refresh_registry=False):
 
         # Even higher priority
         self.hume = hume
+        self.tracer = tracer if tracer is not None else NullTracer()
 
         # Always priority:
         if allow_root is False and os.geteuid() == 0:
@@ -53,7 +721,13 @@ class DO_WP_Maintain():
         # Internal setup
         self.allow_root = allow_root
         self.configpaths = configpaths
+        self.explicit_path = explicit_path
         self.exec_timeout = exec_timeout
+        self.timings = timings  # CommandTimings, or None for exec_timeout
+        # Where run_custom_cmds streams command output
+        if output_sink is None:
+            output_sink = ConsoleOutputSink(verbose=verbose)
+        self.output_sink = output_sink
         self.verbose = verbose
         self.debug = debug
         # Other runtime checks:
@@ -135,7 +809,7 @@ https://github.com/buanzo/hume/wiki''')
                                    'task': 'WPUPDATER'})
 
         if self.explicit_path is True:
-            self.roots_list = [self.configpaths]
+            self.roots_list = list(self.configpaths)
         else:
             self.roots_list = self.get_apache2_documentroots()
         if len(self.roots_list) == 0:
@@ -148,7 +822,22 @@ https://github.com/buanzo/hume/wiki''')
 
         if self.verbose:
             printerr('DocumentRoots: {}'.format(' '.join(self.roots_list)))
-        self.wp_list = self.get_wp_list()
+        # With a saved registry, skip discovery and probing altogether
+        self.registry_path = registry_path
+        self.wp_list = None
+        if registry_path is not None and refresh_registry is False:
+            try:
+                self.wp_list = SiteRegistry.load(registry_path)
+                if self.verbose:
+                    printerr('Loaded {} site(s) from {}'.format(len(self.wp_list),
+                                                                registry_path))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as exc:
+                printerr('Ignoring unreadable site registry {}: {}'.format(registry_path,
+                                                                          exc))
+        if self.wp_list is None:
+            self.wp_list = self.get_wp_list()
 
 
     def is_droplet(self):
@@ -158,56 +847,189 @@ https://github.com/buanzo/hume/wiki''')
             return(True)
         return(False)
 
+    @traced
     def get_wp_list(self):
         # TODO: take into account the security measure of moving
         # TODO: wp-config.php to the parent directory
         # See "Securing wp-config.php" in this article:
         # https://wordpress.org/support/article/hardening-wordpress/
         # There are pro and against voices on that...
-        paths = self.roots_list
-        wp_list = []
-        for path in paths:
-            if self.verbose:
-                printerr('{}: Searching for wp-config.php files'.format(path))
-            for item in Path(path).rglob('wp-config.php'):
-                # Lets try to validate the location by getting wp data
-                # using wp-cli
+        wp_list = SiteRegistry()
+        for path in self.roots_list:
+            for record in self.find_wp_installs(path):
+                wp_list.add(record)
+        return(wp_list)
+
+    def find_wp_installs(self, root, skip=None):
+        # Searches root for wp-config.php files and probes each location.
+        # Paths in skip are neither probed nor returned, so the daemon
+        # can rescan a DocumentRoot without re-probing known installs.
+        found = []
+        if self.verbose:
+            printerr('{}: Searching for wp-config.php files'.format(root))
+        with self.tracer.span('find_wp_installs', root=root) as span:
+            for item in Path(root).rglob('wp-config.php'):
                 potential = os.path.dirname(item)
-                version = self._wp_get_version(path=potential)
-                if self.verbose:
-                    printerr('{}: Found in {}'.format(path, item))
-                if version is None:  # no version? skip.
-                    if self.verbose:
-                        printerr('{}: no version. skipping.'.format(potential))
+                if skip is not None and potential in skip:
                     continue
-                else:  # If we can get the version, get more data
-                    blogname = self._wp_get_blogname(path=potential)
-                    siteurl = self._wp_get_siteurl(path=potential)
-                    wp_list.append({'path': potential,
-                                    'version': version,
-                                    'title': blogname,
-                                    'siteurl': siteurl, })
-        return(wp_list)
+                if self.verbose:
+                    printerr('{}: Found in {}'.format(root, item))
+                site = self.probe_wp_install(potential)
+                if site is not None:
+                    found.append(site)
+            span['found'] = len(found)
+        return(found)
+
+    def probe_wp_install(self, path):
+        # Lets try to validate the location by getting wp data
+        # using wp-cli
+        with self.tracer.span('probe_wp_install', site=path):
+            version = self._wp_get_version(path=path)
+            if version is None:  # no version? skip.
+                if self.verbose:
+                    printerr('{}: no version. skipping.'.format(path))
+                return(None)
+            # If we can get the version, get more data
+            blogname = self._wp_get_blogname(path=path)
+            siteurl = self._wp_get_siteurl(path=path)
+        return(SiteRecord(path,
+                          version,
+                          title=blogname,
+                          siteurl=siteurl,
+                          db_host=self._read_db_host(path),
+                          plugins=self._installed_plugins(path)))
+
+    def _read_db_host(self, path):
+        # Straight from wp-config.php; cheaper than "wp config get"
+        try:
+            with open(os.path.join(path, 'wp-config.php'), errors='replace') as f:
+                m = re.search(r'''define\(\s*['"]DB_HOST['"]\s*,\s*['"]([^'"]*)['"]''',
+                              f.read())
+        except OSError:
+            return(None)
+        if m is None:
+            return(None)
+        return(m.group(1))
+
+    def _installed_plugins(self, path):
+        # Plugin slugs are the directory (or single file) names in
+        # wp-content/plugins, as in "wp plugin list --field=name"
+        slugs = []
+        try:
+            entries = list(os.scandir(os.path.join(path, 'wp-content', 'plugins')))
+        except OSError:
+            return(slugs)
+        for entry in entries:
+            if entry.is_dir():
+                slugs.append(entry.name)
+            elif entry.name.endswith('.php') and entry.name != 'index.php':
+                slugs.append(entry.name[:-4])
+        return(sorted(slugs))
 
-    def _run(self, cmd, timeout):  # cmd must be a []
+    def refresh_site(self, path, version=False, plugins=False):
+        # Updates the registry record of path after a task changed it.
+        # wp-cli and the filesystem are asked first; the record is then
+        # rebuilt under the registry lock from its current state.
+        if path not in self.wp_list:
+            return
+        new_version = self._wp_get_version(path=path) if version else None
+        new_plugins = self._installed_plugins(path) if plugins else None
+        with self.wp_list.lock:
+            record = self.wp_list.get(path)
+            if record is None:
+                return
+            self.wp_list.add(SiteRecord(path,
+                                        new_version or record.version,
+                                        record.title,
+                                        record.siteurl,
+                                        record.db_host,
+                                        record.plugins if new_plugins is None else new_plugins))
+
+    def _run(self, cmd, timeout, capture=None):  # cmd must be a []
         # Is one minute enough as a timeout?
         # This function returns a dictionary
         # status = exit status
         # stdout = utf8-decoded stdout
         # stderr = utf8-decoded stderr
         # Does NOT manage stdin
+        # timed_out = True if killed after timeout; status is then 124,
+        # like coreutils timeout(1)
+        # With a capture (see OutputSink classes) output is streamed to
+        # it and stdout/stderr only hold the last OUTPUT_TAIL bytes.
         if not isinstance(cmd, list):
             raise(ValueError("cmd is not a list"))
-        result = subprocess.run(cmd,
-                                timeout=timeout,  # 300s default
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        if capture is not None:
+            return(self._run_streaming(cmd, timeout, capture))
         retObj = {}
+        try:
+            result = subprocess.run(cmd,
+                                    timeout=timeout,  # 300s default
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired as exc:
+            retObj['status'] = 124
+            retObj['stdout'] = (exc.stdout or b'').decode('utf-8', 'replace')
+            retObj['stderr'] = 'Timed out after {:.0f}s. {}'.format(timeout,
+                                                                (exc.stderr or b'').decode('utf-8', 'replace'))
+            retObj['timed_out'] = True
+            return(retObj)
         retObj['status'] = result.returncode
         retObj['stdout'] = result.stdout.decode('utf-8')
         retObj['stderr'] = result.stderr.decode('utf-8')
+        retObj['timed_out'] = False
         return(retObj)
 
+    def _run_streaming(self, cmd, timeout, capture):
+        tails = {'stdout': bytearray(), 'stderr': bytearray()}
+        timed_out = False
+        try:
+            proc = subprocess.Popen(cmd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except Exception:
+            capture.end()  # sinks may hold a lock until end()
+            raise
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+        sel.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + float(timeout)
+        try:
+            while sel.get_map():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        timed_out = True
+                        proc.kill()
+                        break
+                for key, _ in sel.select(remaining):
+                    chunk = os.read(key.fd, OUTPUT_CHUNK)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        continue
+                    capture.write(key.data, chunk)
+                    tail = tails[key.data]
+                    tail.extend(chunk)
+                    del tail[:-OUTPUT_TAIL]
+        finally:
+            sel.close()
+            proc.stdout.close()
+            proc.stderr.close()
+            proc.wait()
+            capture.end()
+        retObj = {}
+        retObj['status'] = 124 if timed_out else proc.returncode
+        retObj['stdout'] = tails['stdout'].decode('utf-8', 'replace')
+        retObj['stderr'] = tails['stderr'].decode('utf-8', 'replace')
+        if timed_out:
+            retObj['stderr'] = 'Timed out after {:.0f}s. {}'.format(timeout,
+                                                                    retObj['stderr'])
+        retObj['timed_out'] = timed_out
+        return(retObj)
+
+    @traced
     def test_wpcli_works(self):
         r = False  # Return False by default
         v = ''
@@ -222,13 +1044,49 @@ https://github.com/buanzo/hume/wiki''')
             r = True  # only case r will be True
         return(r)
 
-    def wp_run(self, path, args):
+    def wp_run(self, path, args, capture=None, read_only=None):
         cmd = [self.path_to_wpcli, '--no-color']
         if self.allow_root is True:  # __init__ checks EUID and --allow-root
             cmd.append('--allow-root')
         cmd.append('--path={}'.format(path))
         cmd.extend(args)
-        return(self._run(cmd,timeout=self.exec_timeout))
+        if self.timings is None:
+            timeout = self.exec_timeout
+        else:
+            timeout = self.timings.timeout_for(path, args, read_only=read_only)
+        with self.tracer.span('wp_run', site=path, args=' '.join(args),
+                              timeout=timeout) as span:
+            start = time.monotonic()
+            r = self._run(cmd,timeout=timeout,capture=capture)
+            span['status'] = r['status']
+        if self.timings is not None:
+            self.timings.record(path, args, time.monotonic() - start,
+                                timed_out=r['timed_out'])
+        return(r)
+
+    def save_state(self):
+        # Persists what should survive this run: timing stats and the
+        # site registry
+        if self.timings is not None:
+            self.timings.save()
+        if self.registry_path is not None:
+            self.wp_list.save(self.registry_path)
+
+    def report_overruns(self):
+        # Surfaces sites whose commands keep hitting their timeout
+        if self.timings is None:
+            return([])
+        overruns = self.timings.overruns()
+        for site, cmdtype, count in overruns:
+            msg = '"{}" in {} timed out {} times in its last 10 runs'.format(cmdtype,
+                                                                              site,
+                                                                              count)
+            printerr(msg)
+            if self.hume:
+                self.Hume({'level': 'warning',
+                           'msg': msg,
+                           'task': 'WPUPDATER'})
+        return(overruns)
 
     def _wp_get_version(self, path):
         args = ['core', 'version', ]
@@ -245,13 +1103,30 @@ https://github.com/buanzo/hume/wiki''')
             return(False)
         return(True)
 
-    def update_core(self):
+    def _sites(self, sites):
+        # Tasks run on every discovered site unless given a subset
+        if sites is None:
+            return(list(self.wp_list))
+        return(sites)
+
+    def _task_result(self, path, args, r):
+        return({'path': path,
+                'cmd': ' '.join(args),
+                'status': r['status'],
+                'stderr': r['stderr'], })
+
+    @traced
+    def update_core(self, sites=None):
         args = ['core', 'update']
-        for site in self.wp_list:
-            path = site['path']
+        results = []
+        for site in self._sites(sites):
+            path = site.path
             if self.verbose:
                 printerr('Updating Wordpress Core in {}'.format(path))
             r = self.wp_run(path=path, args=args)
+            results.append(self._task_result(path, args, r))
+            if r['status'] == 0:
+                self.refresh_site(path, version=True)
             if r['status'] > 0:
                 msg = 'Error updating core {}: {}'.format(path, r['stderr'])
                 printerr(msg)
@@ -259,14 +1134,18 @@ https://github.com/buanzo/hume/wiki''')
                     self.Hume({'level': 'warning',
                                'msg': msg,
                                'task': 'WPUPDATER'})
+        return(results)
 
-    def update_db(self):
+    @traced
+    def update_db(self, sites=None):
         args = ['core', 'update-db']
-        for site in self.wp_list:
-            path = site['path']
+        results = []
+        for site in self._sites(sites):
+            path = site.path
             if self.verbose:
                 printerr('Updating Wordpress Database in {}'.format(path))
             r = self.wp_run(path=path, args=args)
+            results.append(self._task_result(path, args, r))
             if r['status'] > 0:
                 msg = 'Error updating database {}: {}'.format(path,
                                                               r['stderr'])
@@ -275,6 +1154,7 @@ https://github.com/buanzo/hume/wiki''')
                     self.Hume({'level': 'warning',
                                'msg': msg,
                                'task': 'WPUPDATER'})
+        return(results)
 
     def get_plugin_list(self,path):
         wpl = []
@@ -296,23 +1176,33 @@ https://github.com/buanzo/hume/wiki''')
             wtl.extend(_wtl)
         return(wtl)
 
-    def update_plugins(self):
-        for site in self.wp_list:
-            path = site['path']
+    @traced
+    def update_plugins(self, sites=None):
+        results = []
+        for site in self._sites(sites):
+            path = site.path
             if self.verbose:
                 printerr('Getting list of Wordpress Plugins in {}'.format(path))
             wpl = self.get_plugin_list(path=path)
             for pluginName in wpl:
-                self.update_plugin(pluginName,path=path)
+                r = self.update_plugin(pluginName,path=path)
+                if r is not None:
+                    results.append(r)
+        return(results)
 
-    def update_themes(self):
-        for site in self.wp_list:
-            path = site['path']
+    @traced
+    def update_themes(self, sites=None):
+        results = []
+        for site in self._sites(sites):
+            path = site.path
             if self.verbose:
                 printerr('Getting list of Wordpress Themes in {}'.format(path))
             wtl = self.get_theme_list(path=path)
             for themeName in wtl:
-                self.update_theme(themeName,path=path)
+                r = self.update_theme(themeName,path=path)
+                if r is not None:
+                    results.append(r)
+        return(results)
 
     def skip_theme_update(self, themeName, path):
         for item in self.skip_themes:
@@ -357,6 +1247,7 @@ https://github.com/buanzo/hume/wiki''')
                 self.Hume({'level': 'warning',
                            'msg': msg,
                            'task': 'WPUPDATER'})
+        return(self._task_result(path, args, r))
 
     def update_theme(self, themeName, path):
         if self.skip_theme_update(themeName,path):
@@ -374,7 +1265,9 @@ https://github.com/buanzo/hume/wiki''')
                 self.Hume({'level': 'warning',
                            'msg': msg,
                            'task': 'WPUPDATER'})
+        return(self._task_result(path, args, r))
 
+    @traced
     def update_wpcli(self):
         args = ['cli', 'update', '--yes']
         r = self.wp_run(path='/tmp', args=args)
@@ -386,13 +1279,16 @@ https://github.com/buanzo/hume/wiki''')
                            'msg': msg,
                            'task': 'WPUPDATER'})
 
-    def optimize_database(self):
+    @traced
+    def optimize_database(self, sites=None):
         args = ['db', 'optimize']
-        for site in self.wp_list:
-            path = site['path']
+        results = []
+        for site in self._sites(sites):
+            path = site.path
             if self.verbose:
                 printerr('Optimizing database in {}'.format(path))
             r = self.wp_run(path=path, args=args)
+            results.append(self._task_result(path, args, r))
             if r['status'] > 0:
                 msg = 'Error whilst optimizing database {}: {}'.format(path,
                                                                        r['stderr'])
@@ -401,14 +1297,18 @@ https://github.com/buanzo/hume/wiki''')
                     self.Hume({'level': 'warning',
                                'msg': msg,
                                'task': 'WPUPDATER'})
+        return(results)
 
-    def delete_expired_transients(self):
+    @traced
+    def delete_expired_transients(self, sites=None):
         args = ['transient', 'delete', '--expired']
-        for site in self.wp_list:
-            path = site['path']
+        results = []
+        for site in self._sites(sites):
+            path = site.path
             if self.verbose:
                 printerr('Deleting expired transients in {}'.format(path))
             r = self.wp_run(path=path, args=args)
+            results.append(self._task_result(path, args, r))
             if r['status'] > 0:
                 msg = 'Error deleting transients {}: {}'.format(path,
                                                                 r['stderr'])
@@ -417,6 +1317,7 @@ https://github.com/buanzo/hume/wiki''')
                     self.Hume({'level': 'warning',
                                'msg': msg,
                                'task': 'WPUPDATER'})
+        return(results)
 
     def _wp_get_blogname(self, path):
         args = ['option', 'get', 'blogname', ]
@@ -428,14 +1329,21 @@ https://github.com/buanzo/hume/wiki''')
         siteurl = self.wp_run(path=path, args=args)['stdout'].strip()
         return(siteurl)
 
-    def run_custom_cmds(self, cmds):
-        for cmd in cmds:
-            args = cmd.split(' ')
-            for site in self.wp_list:
-                path = site['path']
+    @traced
+    def run_custom_cmds(self, cmds, sites=None):
+        # All commands run on a site before moving on to the next one, and
+        # their output is streamed to self.output_sink.
+        results = []
+        cmds = [(cmd, shlex.split(cmd)) for cmd in cmds]
+        for site in self._sites(sites):
+            path = site.path
+            for cmd, args in cmds:
                 if self.verbose:
                     printerr('Running {} in {}'.format(cmd, path))
-                r = self.wp_run(path=path, args=args)
+                capture = self.output_sink.begin(path, args)
+                r = self.wp_run(path=path, args=args, capture=capture,
+                                read_only=False)
+                results.append(self._task_result(path, args, r))
                 if r['status'] > 0:
                     msg = 'Error running "{}" in {}: {}'.format(cmd, path,
                                                                 r['stderr'])
@@ -444,9 +1352,9 @@ https://github.com/buanzo/hume/wiki''')
                         self.Hume({'level': 'warning',
                                    'msg': msg,
                                    'task': 'WPUPDATER'})
-                else:
-                    if self.verbose:
-                        printerr(r['stdout'])
+            # Commands may have installed or removed plugins
+            self.refresh_site(path, plugins=True)
+        return(results)
 
     def get_do_metadata(self):
         try:
@@ -500,8 +1408,10 @@ https://github.com/buanzo/hume/wiki''')
                 continue
         return(paths)
 
+    @traced
     def get_apache2_documentroots(self):
         documentroots = []
+        self.apache_config_errors = 0  # the daemon keeps old roots if > 0
         # apacheconfig options
         options = {
             'includerelative': True,
@@ -523,6 +1433,8 @@ https://github.com/buanzo/hume/wiki''')
                     self.Hume({'level': 'critical',
                                'msg': msg,
                                'task': 'WPUPDATER'})
+                self.apache_config_errors += 1
+                continue
             documentroots.extend(self._extract_documentroots(config))
         documentroots = list(set(documentroots))
         return(documentroots)
@@ -538,37 +1450,922 @@ Check out https://www.github.com/buanzo/hume/wiki''')
             printerr(exc)
             printerr('Continuing...')
             return(None)
-        hume.Hume(msg).send()
+        with self.tracer.span('Hume', level=msg.get('level')):
+            hume.Hume(msg).send()
 
-def run():
-    # TODO: ArgParse for droplet required tags
-    parser = argparse.ArgumentParser(description='''Tool that implements wp-cli
-maintenance tasks on servers that use Apache2, with a few useful features on
-DigitalOcean droplets.
-Future versions may support nginx/lighttpd.
-Author: Buanzo - https://www.github.com/buanzo''')
-    parser.add_argument('-t', '--tags',
-                        type=lambda arg: arg.split(','),
-                        action='append',
-                        default=None,
-                        dest='requiredtags',
-                        help='''Comma-separated list of required droplet tags.
-All tags must be assigned to droplet for maintenance to happen. May
-be used multiple times.''')
-    parser.add_argument('file',
-                        nargs='+',
-                        help='''Path to configuration files to extract
-DocumentRoots from.''')
-    parser.add_argument('--allow-root',
-                        default=False,
-                        action='store_true',
-                        dest='allow_root',
-                        help='Enables usage of this script as root. AVOID.')
-    parser.add_argument('--list-only',
-                        default=False,
-                        action='store_true',
-                        dest='list_only',
-                        help='List Wordpress installations that were found.')
+class Inotify():
+    # Minimal ctypes binding for the Linux inotify API. Events are returned
+    # as (watched path, mask, name) tuples; name is empty for events on a
+    # watched file or on the watched directory itself.
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    DIR_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    FILE_MASK = IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libname = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise(OSError('inotify is not available on this platform'))
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise(OSError(err, os.strerror(err)))
+        self.watches = {}  # wd -> path
+        self.paths = {}    # path -> wd
+
+    def add_watch(self, path, mask=DIR_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise(OSError(err, os.strerror(err), path))
+        self.watches[wd] = path
+        self.paths[path] = wd
+        return(wd)
+
+    def rm_watch(self, path):
+        wd = self.paths.pop(path, None)
+        if wd is None:
+            return
+        self.watches.pop(wd, None)
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return([])
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return([])
+        events = []
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, cookie, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            path = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                # Kernel dropped the watch (directory removed/unmounted)
+                self.watches.pop(wd, None)
+                if path is not None:
+                    self.paths.pop(path, None)
+            events.append((path, mask, os.fsdecode(name)))
+        return(events)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WPUpdaterDaemon():
+    # Keeps discovery state of a DO_WP_Maintain instance hot. Apache config
+    # directories, DocumentRoots, each install and its wp-includes/version.php
+    # are watched with inotify, so vhosts and installs that appear or go
+    # away update the site list incrementally instead of via a full rescan.
+    # Directories created below a DocumentRoot are watched as candidates
+    # (up to candidate_depth levels, for candidate_ttl seconds) so an
+    # install unpacked there is picked up as soon as wp-config.php lands.
+    def __init__(self,
+                 dowp,
+                 args,
+                 socket_path,
+                 interval=86400,
+                 new_site_delay=120,
+                 rescan_interval=21600,
+                 settle=5,
+                 candidate_depth=2,
+                 candidate_ttl=86400):
+        self.dowp = dowp
+        self.args = args
+        self.socket_path = socket_path
+        self.interval = interval
+        self.new_site_delay = new_site_delay
+        self.rescan_interval = rescan_interval
+        self.settle = settle
+        self.candidate_depth = candidate_depth
+        self.candidate_ttl = candidate_ttl
+        self.verbose = dowp.verbose
+        self.lock = threading.RLock()
+        self.run_now = threading.Event()
+        self.stopping = threading.Event()
+        self.started = time.time()
+        self.running = False
+        self.last_run = None
+        self.last_results = []
+        self.next_run = time.time()  # First maintenance run right away
+        self.next_rescan = time.time() + rescan_interval
+        self.pending_sites = {}      # path -> not-before timestamp
+        self.dirty_config = None     # timestamp of last config event
+        self.dirty_roots = {}        # root -> timestamp of last event
+        self.dirty_installs = {}     # install path -> timestamp
+        self.candidates = {}         # new subdirectory -> (depth, expires)
+        self.server = None
+        self.watched_config_dirs = set()
+        try:
+            self.inotify = Inotify()
+        except OSError as exc:
+            printerr('inotify unavailable ({}), falling back to periodic '
+                     'rescans only.'.format(exc))
+            self.inotify = None
+
+    def log(self, msg):
+        if self.verbose:
+            printerr('daemon: {}'.format(msg))
+
+    def site_paths(self):
+        with self.lock:
+            return(set(self.dowp.wp_list.paths()))
+
+    def config_dirs(self):
+        # The vhost files themselves are usually Include'd from a
+        # subdirectory (sites-enabled, conf.d...), so watch the config
+        # root and its immediate subdirectories.
+        if self.dowp.explicit_path is True:
+            return(set())
+        dirs = set()
+        for configpath in self.dowp.configpaths:
+            configroot = os.path.dirname(os.path.abspath(configpath))
+            dirs.add(configroot)
+            try:
+                for entry in os.scandir(configroot):
+                    if entry.is_dir():
+                        dirs.add(entry.path)
+            except OSError:
+                pass
+        return(dirs)
+
+    def add_candidate(self, path, depth):
+        # Watch a new directory until it turns into an install or expires
+        if depth > self.candidate_depth or path in self.candidates:
+            return
+        self.log('watching new directory {}'.format(path))
+        self.candidates[path] = (depth, time.time() + self.candidate_ttl)
+        if self.inotify is not None and path not in self.inotify.paths:
+            try:
+                self.inotify.add_watch(path)
+            except OSError as exc:
+                self.log('cannot watch {}: {}'.format(path, exc))
+        # Anything that landed before the watch was in place
+        if os.path.isfile(os.path.join(path, 'wp-config.php')):
+            self.dirty_installs[path] = time.time()
+        try:
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    self.add_candidate(entry.path, depth + 1)
+        except OSError:
+            pass
+
+    def prune_candidates(self):
+        now = time.time()
+        sites = self.site_paths()
+        for path, (depth, expires) in list(self.candidates.items()):
+            if path in sites or expires < now or not os.path.isdir(path):
+                del self.candidates[path]
+
+    @staticmethod
+    def version_file(path):
+        return(os.path.join(path, 'wp-includes', 'version.php'))
+
+    def sync_watches(self):
+        if self.inotify is None:
+            return
+        self.prune_candidates()
+        self.watched_config_dirs = self.config_dirs()
+        wanted = set(self.watched_config_dirs)
+        wanted.update(self.candidates)
+        files = set()
+        with self.lock:
+            wanted.update(self.dowp.roots_list)
+            for path in self.dowp.wp_list.paths():
+                wanted.add(path)
+                files.add(self.version_file(path))
+        # Only version.php, not all of wp-includes: a core update rewrites
+        # hundreds of files there while nobody is reading events.
+        wanted.update(files)
+        for path in set(self.inotify.paths) - wanted:
+            self.inotify.rm_watch(path)
+        for path in wanted - set(self.inotify.paths):
+            mask = Inotify.FILE_MASK if path in files else Inotify.DIR_MASK
+            try:
+                self.inotify.add_watch(path, mask)
+            except OSError as exc:
+                self.log('cannot watch {}: {}'.format(path, exc))
+
+    def add_sites(self, sites):
+        if not sites:
+            return
+        with self.lock:
+            for site in sites:
+                if site.path in self.dowp.wp_list:
+                    continue
+                self.log('new site {}'.format(site.path))
+                self.dowp.wp_list.add(site)
+                self.pending_sites[site.path] = (time.time() +
+                                                 self.new_site_delay)
+
+    def remove_sites(self, paths):
+        if not paths:
+            return
+        with self.lock:
+            for path in paths:
+                self.log('site gone {}'.format(path))
+                self.pending_sites.pop(path, None)
+            for path in paths:
+                self.dowp.wp_list.remove(path)
+
+    def reprobe(self, path):
+        site = None
+        if os.path.isfile(os.path.join(path, 'wp-config.php')):
+            site = self.dowp.probe_wp_install(path)
+        if site is None:
+            if path in self.dowp.wp_list:
+                self.remove_sites(set([path]))
+            return
+        with self.lock:
+            if path in self.dowp.wp_list:
+                self.dowp.wp_list.add(site)  # replaces the old record
+                return
+        self.add_sites([site])
+
+    def rescan_root(self, root):
+        self.add_sites(self.dowp.find_wp_installs(root,
+                                                  skip=self.site_paths()))
+
+    def reload_config(self):
+        self.log('reloading Apache configuration')
+        roots = self.dowp.get_apache2_documentroots()
+        if self.dowp.apache_config_errors > 0:
+            # Half-edited vhost: don't drop sites, wait for the next save
+            printerr('daemon: Apache configuration has errors, keeping {} DocumentRoot(s)'.format(len(self.dowp.roots_list)))
+            return
+        with self.lock:
+            old = set(self.dowp.roots_list)
+            self.dowp.roots_list = roots
+        added = set(roots) - old
+        removed = old - set(roots)
+        if removed:
+            gone = set()
+            for path in self.site_paths():
+                under = [root for root in roots
+                         if path == root or path.startswith(root.rstrip('/') + '/')]
+                if not under:
+                    gone.add(path)
+            self.remove_sites(gone)
+        for root in added:
+            self.log('new DocumentRoot {}'.format(root))
+            self.rescan_root(root)
+
+    def full_rescan(self):
+        self.log('periodic full rescan')
+        if self.dowp.explicit_path is not True:
+            self.reload_config()
+        for path in self.site_paths():
+            self.reprobe(path)
+        for root in list(self.dowp.roots_list):
+            self.rescan_root(root)
+
+    def handle_event(self, path, mask, name):
+        now = time.time()
+        if mask & Inotify.IN_Q_OVERFLOW:
+            # Sent with wd -1, so path is None. Events were lost: rescan.
+            self.log('inotify queue overflow, rescanning')
+            self.next_rescan = now
+            return
+        if path is None:
+            return
+        if path in self.watched_config_dirs:
+            self.dirty_config = now
+        sites = self.site_paths()
+        if path in self.dowp.roots_list:
+            depth = 0
+            if mask & Inotify.IN_ISDIR or name == 'wp-config.php':
+                self.dirty_roots[path] = now
+        elif path in self.candidates:
+            depth = self.candidates[path][0]
+            if name == 'wp-config.php':
+                self.dirty_installs[path] = now
+        else:
+            depth = None
+        if (depth is not None and name and mask & Inotify.IN_ISDIR and
+                mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO)):
+            self.add_candidate(os.path.join(path, name), depth + 1)
+        if path in sites:
+            if name == 'wp-config.php' or mask & (Inotify.IN_DELETE_SELF |
+                                                  Inotify.IN_MOVE_SELF):
+                self.dirty_installs[path] = now
+        elif not name:
+            site = os.path.dirname(os.path.dirname(path))
+            if site in sites and path == self.version_file(site):
+                self.dirty_installs[site] = now
+
+    def process_dirty(self):
+        # Events come in bursts (unzips, editors, core updates), so act on
+        # a path only after it has been quiet for self.settle seconds.
+        settled = time.time() - self.settle
+        changed = False
+        if self.dirty_config is not None and self.dirty_config < settled:
+            self.dirty_config = None
+            self.reload_config()
+            changed = True
+        for root, stamp in list(self.dirty_roots.items()):
+            if stamp < settled:
+                del self.dirty_roots[root]
+                self.rescan_root(root)
+                changed = True
+        for path, stamp in list(self.dirty_installs.items()):
+            if stamp < settled:
+                del self.dirty_installs[path]
+                self.reprobe(path)
+                changed = True
+        if changed:
+            self.sync_watches()
+
+    def maintain(self, sites=None):
+        if sites is None:
+            with self.lock:
+                sites = list(self.dowp.wp_list)
+                self.pending_sites = {}
+        self.running = True
+        self.log('maintenance run on {} site(s)'.format(len(sites)))
+        try:
+            results = run_tasks(self.dowp, self.args, sites=sites)
+        finally:
+            self.running = False
+        with self.lock:
+            self.last_run = time.time()
+            self.last_results = results
+        self.dowp.save_state()
+        self.dowp.report_overruns()
+
+    def pending_due(self):
+        now = time.time()
+        with self.lock:
+            due = [path for path, stamp in self.pending_sites.items()
+                   if stamp <= now]
+            for path in due:
+                del self.pending_sites[path]
+            return([self.dowp.wp_list.get(path) for path in due
+                    if path in self.dowp.wp_list])
+
+    def status(self):
+        with self.lock:
+            failures = [r for r in self.last_results if r['status'] != 0]
+            return({'pid': os.getpid(),
+                    'version': __version__,
+                    'uptime': int(time.time() - self.started),
+                    'running': self.running,
+                    'sites': len(self.dowp.wp_list),
+                    'roots': len(self.dowp.roots_list),
+                    'watches': (len(self.inotify.paths)
+                                if self.inotify is not None else 0),
+                    'pending_new_sites': len(self.pending_sites),
+                    'last_run': self.last_run,
+                    'last_run_commands': len(self.last_results),
+                    'last_run_failures': failures,
+                    'overruns': (self.dowp.timings.overruns()
+                                 if self.dowp.timings is not None else []),
+                    'next_run': self.next_run, })
+
+    def handle_request(self, line):
+        cmd = line.strip().lower()
+        if cmd == 'list':
+            with self.lock:
+                return({'sites': [site.as_dict() for site in self.dowp.wp_list]})
+        if cmd == 'status':
+            return(self.status())
+        if cmd in ('run', 'run now'):
+            self.run_now.set()
+            return({'queued': True})
+        return({'error': 'unknown command "{}". Use list, status or run.'.format(cmd)})
+
+    def check_socket(self):
+        # Only a socket nobody listens on is stale; a live one belongs to
+        # another daemon that must keep its API.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except ConnectionRefusedError:
+            os.unlink(self.socket_path)  # stale socket from a previous run
+            return
+        except OSError as exc:
+            raise(RuntimeError('Cannot use daemon socket {}: {}'.format(self.socket_path, exc)))
+        finally:
+            probe.close()
+        raise(RuntimeError('Another wpupdater daemon is listening on {}'.format(self.socket_path)))
+
+    def start_server(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline(1024).decode('utf-8', 'replace')
+                reply = daemon.handle_request(line)
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+        if os.path.exists(self.socket_path):
+            self.check_socket()
+        oldmask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path,
+                                                                 Handler)
+        finally:
+            os.umask(oldmask)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='wpupdater-api',
+                                  daemon=True)
+        thread.start()
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def step(self, func, *args, **kwargs):
+        # Runs one unit of daemon work. Errors are reported and the daemon
+        # keeps going; a bad vhost or a failing site must not kill it.
+        try:
+            return(func(*args, **kwargs))
+        except Exception as exc:
+            msg = 'daemon: error in {}: {!r}'.format(func.__name__, exc)
+            printerr(msg)
+            if self.dowp.hume:
+                self.dowp.Hume({'level': 'error',
+                                'msg': msg,
+                                'task': 'WPUPDATER'})
+            return(None)
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start_server()
+        self.sync_watches()
+        printerr('wpupdater daemon: {} site(s), API on {}'.format(len(self.dowp.wp_list),
+                                                                  self.socket_path))
+        try:
+            while not self.stopping.is_set():
+                if self.inotify is not None:
+                    events = self.step(self.inotify.read_events, 1.0) or []
+                    for path, mask, name in events:
+                        self.step(self.handle_event, path, mask, name)
+                else:
+                    self.stopping.wait(1.0)
+                self.step(self.process_dirty)
+                now = time.time()
+                if now >= self.next_rescan:
+                    self.next_rescan = now + self.rescan_interval
+                    self.step(self.full_rescan)
+                    self.step(self.sync_watches)
+                if self.run_now.is_set() or now >= self.next_run:
+                    self.run_now.clear()
+                    self.next_run = now + self.interval
+                    self.step(self.maintain)
+                    continue
+                due = self.step(self.pending_due)
+                if due:
+                    self.step(self.maintain, sites=due)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            if self.inotify is not None:
+                self.inotify.close()
+            self.dowp.save_state()
+
+
+def fleet_signature(secret, method, path, timestamp, body):
+    # HMAC-SHA256 over the request line, timestamp and body. Shared
+    # between coordinator and agents, so a captured request cannot be
+    # altered and stops being accepted after FLEET_MAX_SKEW seconds.
+    msg = '\n'.join((method, path, str(timestamp))).encode('utf-8')
+    return(hmac.new(secret, msg + b'\n' + body, hashlib.sha256).hexdigest())
+
+
+FLEET_MAX_SKEW = 300
+FLEET_MAX_BODY = 1024 * 1024  # requests are read before they are verified
+
+
+def read_fleet_secret(path):
+    try:
+        with open(path, 'rb') as f:
+            secret = f.read().strip()
+    except OSError as exc:
+        raise(RuntimeError('Cannot read secret file {}: {}'.format(path, exc)))
+    if len(secret) < 16:
+        raise(RuntimeError('Secret in {} is too short (16 bytes minimum)'.format(path)))
+    return(secret)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer only exists since Python 3.7
+    daemon_threads = True
+
+
+class WPUpdaterAgent():
+    # Lightweight HTTP endpoint that lets a coordinator drive the local
+    # DO_WP_Maintain instance:
+    #   GET  /sites  -> {"hostname", "tags", "sites"}
+    #   POST /run    {"task", "path"[, "cmds"]} -> {"results"}
+    # Every request must carry a valid X-WPUpdater-Signature.
+    # A fleet run makes one /run request per site and task, so timing
+    # stats and the registry are saved every save_interval seconds (and
+    # on shutdown) rather than after each request.
+    def __init__(self, dowp, listen, secret, tags=None, allow_run=False,
+                 save_interval=60):
+        self.dowp = dowp
+        host, _, port = listen.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.secret = secret
+        self.tags = sorted(set(tags or []))
+        self.allow_run = allow_run
+        self.save_interval = save_interval
+        self.unsaved = threading.Event()
+        self.verbose = dowp.verbose
+
+    def flush(self):
+        if self.unsaved.is_set():
+            self.unsaved.clear()
+            self.dowp.save_state()
+
+    def saver(self, stopping):
+        while not stopping.wait(self.save_interval):
+            self.flush()
+
+    def authorized(self, method, path, headers, body):
+        try:
+            timestamp = int(headers.get('X-WPUpdater-Timestamp', ''))
+        except ValueError:
+            return(False)
+        if abs(time.time() - timestamp) > FLEET_MAX_SKEW:
+            return(False)
+        expected = fleet_signature(self.secret, method, path, timestamp, body)
+        given = headers.get('X-WPUpdater-Signature', '')
+        return(hmac.compare_digest(expected, given))
+
+    def find_site(self, path):
+        return(self.dowp.wp_list.get(path))
+
+    def handle(self, method, path, body):
+        # Returns (http status, reply object)
+        if method == 'GET' and path == '/sites':
+            return(200, {'hostname': socket.gethostname(),
+                         'version': __version__,
+                         'tags': self.tags,
+                         'sites': [site.as_dict() for site in self.dowp.wp_list], })
+        if method == 'POST' and path == '/run':
+            try:
+                req = json.loads(body.decode('utf-8'))
+                task = req['task']
+                site = self.find_site(req['path'])
+            except (ValueError, KeyError, TypeError):
+                return(400, {'error': 'malformed request'})
+            if task not in dict(TASKS):
+                return(400, {'error': 'unknown task "{}"'.format(task)})
+            if site is None:
+                return(404, {'error': 'unknown site "{}"'.format(req['path'])})
+            if task == 'custom' and not self.allow_run:
+                return(403, {'error': 'custom commands need --agent-allow-run'})
+            cmds = req.get('cmds')
+            if task == 'custom' and (not isinstance(cmds, list) or not cmds or
+                                     not all(isinstance(cmd, str) for cmd in cmds)):
+                return(400, {'error': '"cmds" must be a non-empty list of strings'})
+            if self.verbose:
+                printerr('agent: {} on {}'.format(task, site.path))
+            results = run_task(self.dowp, task, sites=[site], cmds=cmds)
+            self.unsaved.set()
+            return(200, {'results': results})
+        return(404, {'error': 'not found'})
+
+    def make_server(self):
+        # Port 0 binds an ephemeral port; see server.server_address
+        agent = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def reply(self, code, obj):
+                data = json.dumps(obj).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def dispatch(self):
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > FLEET_MAX_BODY:
+                    self.close_connection = True  # body is left unread
+                    if length < 0:
+                        self.reply(400, {'error': 'bad Content-Length'})
+                    else:
+                        self.reply(413, {'error': 'request body too large'})
+                    return
+                body = self.rfile.read(length) if length > 0 else b''
+                if not agent.authorized(self.command, self.path,
+                                        self.headers, body):
+                    self.reply(401, {'error': 'bad or missing signature'})
+                    return
+                self.reply(*agent.handle(self.command, self.path, body))
+
+            def do_GET(self):
+                self.dispatch()
+
+            def do_POST(self):
+                self.dispatch()
+
+            def log_message(self, fmt, *args):
+                if agent.verbose:
+                    printerr('agent: ' + fmt % args)
+
+        return(ThreadingHTTPServer(self.address, Handler))
+
+    def serve(self):
+        server = self.make_server()
+        stopping = threading.Event()
+        saver = threading.Thread(target=self.saver, args=(stopping,),
+                                 name='wpupdater-saver', daemon=True)
+        saver.start()
+        # shutdown() waits for serve_forever(), so it can't run in the
+        # main thread's signal handler
+        signal.signal(signal.SIGTERM,
+                      lambda *args: threading.Thread(target=server.shutdown).start())
+        printerr('wpupdater agent: {} site(s), listening on {}:{}'.format(len(self.dowp.wp_list),
+                                                                        *server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            stopping.set()
+            saver.join()
+            self.flush()
+
+
+class FleetCoordinator():
+    # Hands out per-site work to wpupdater agents while enforcing global
+    # limits: max_parallel sites in flight fleet-wide, per_agent sites in
+    # flight per agent, and optional per-task limits (e.g. core=10).
+    # With stagger, agents carrying the first tag run first, then the
+    # next tag, and so on; untagged leftovers go last.
+    def __init__(self,
+                 agents,
+                 secret,
+                 tasks,
+                 cmds=None,
+                 max_parallel=10,
+                 per_agent=2,
+                 task_limits=None,
+                 stagger=None,
+                 stagger_pause=0,
+                 stop_on_failure=False,
+                 request_timeout=3600,
+                 verbose=False):
+        if max_parallel < 1 or per_agent < 1:
+            raise(ValueError('max_parallel and per_agent must be at least 1'))
+        self.agents = [self.agent_url(agent) for agent in agents]
+        self.secret = secret
+        self.tasks = tasks
+        self.cmds = cmds
+        self.max_parallel = max_parallel
+        self.per_agent = per_agent
+        self.task_limits = dict((task, threading.BoundedSemaphore(limit))
+                                for task, limit in (task_limits or {}).items())
+        self.stagger = stagger or []
+        self.stagger_pause = stagger_pause
+        self.stop_on_failure = stop_on_failure
+        self.request_timeout = request_timeout
+        self.verbose = verbose
+        self.fleet_slots = threading.BoundedSemaphore(max_parallel)
+        self.lock = threading.Lock()
+        self.results = []
+        self.inventory = {}
+
+    @staticmethod
+    def agent_url(agent):
+        if '://' not in agent:
+            agent = 'http://' + agent
+        return(agent.rstrip('/'))
+
+    def request(self, agent, method, path, payload=None):
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        timestamp = int(time.time())
+        headers = {'X-WPUpdater-Timestamp': str(timestamp),
+                   'X-WPUpdater-Signature': fleet_signature(self.secret, method,
+                                                            path, timestamp,
+                                                            body),
+                   'Content-Type': 'application/json', }
+        r = requests.request(method, agent + path, data=body, headers=headers,
+                             timeout=self.request_timeout)
+        try:
+            reply = r.json()
+        except ValueError:
+            reply = {'error': r.text}
+        if r.status_code != 200:
+            raise(RuntimeError('{} {}: HTTP {}: {}'.format(agent, path,
+                                                          r.status_code,
+                                                          reply.get('error'))))
+        return(reply)
+
+    def collect_inventory(self):
+        for agent in self.agents:
+            try:
+                self.inventory[agent] = self.request(agent, 'GET', '/sites')
+            except Exception as exc:
+                printerr('Cannot reach agent {}: {}'.format(agent, exc))
+                self.inventory[agent] = {'error': str(exc)}
+
+    def waves(self):
+        # Returns lists of agents, one per stagger step
+        reachable = [agent for agent in self.agents
+                     if 'error' not in self.inventory[agent]]
+        waves = []
+        for tag in self.stagger:
+            wave = [agent for agent in reachable
+                    if tag in self.inventory[agent].get('tags', [])]
+            reachable = [agent for agent in reachable if agent not in wave]
+            if wave:
+                waves.append(wave)
+        if reachable:
+            waves.append(reachable)
+        return(waves)
+
+    def record(self, agent, path, task, results):
+        with self.lock:
+            for r in results:
+                r = dict(r)
+                r['agent'] = agent
+                r['task'] = task
+                self.results.append(r)
+
+    def agent_worker(self, agent, work):
+        # per_agent of these run for each agent, so an agent never has more
+        # than per_agent sites in flight. Each site also holds one of the
+        # max_parallel fleet-wide slots while it runs.
+        while True:
+            try:
+                path = work.get_nowait()
+            except queue.Empty:
+                return
+            with self.fleet_slots:
+                self.maintain_site(agent, path)
+
+    def maintain_site(self, agent, path):
+        # Tasks for one site run in order; each task call holds the task
+        # limit (if any) only while it runs on the agent.
+        for task in self.tasks:
+            limit = self.task_limits.get(task)
+            if limit is not None:
+                limit.acquire()
+            try:
+                if self.verbose:
+                    printerr('{}: {} on {}'.format(agent, task, path))
+                reply = self.request(agent, 'POST', '/run',
+                                     {'task': task,
+                                      'path': path,
+                                      'cmds': self.cmds, })
+                self.record(agent, path, task, reply['results'])
+            except Exception as exc:
+                msg = 'Error running {} on {} {}: {}'.format(task, agent,
+                                                             path, exc)
+                printerr(msg)
+                self.record(agent, path, task, [{'path': path,
+                                                 'cmd': None,
+                                                 'status': -1,
+                                                 'stderr': str(exc), }])
+            finally:
+                if limit is not None:
+                    limit.release()
+
+    def failures(self):
+        return([r for r in self.results if r['status'] != 0])
+
+    def run(self):
+        started = time.time()
+        self.collect_inventory()
+        waves = self.waves()
+        for i, wave in enumerate(waves):
+            if i > 0:
+                if self.stop_on_failure and self.failures():
+                    printerr('Failures in previous wave, not starting the next one.')
+                    break
+                if self.stagger_pause > 0:
+                    time.sleep(self.stagger_pause)
+            workers = []
+            total = 0
+            for agent in wave:
+                work = queue.Queue()
+                for site in self.inventory[agent].get('sites', []):
+                    work.put(site['path'])
+                total += work.qsize()
+                for n in range(min(self.per_agent, work.qsize())):
+                    workers.append(threading.Thread(target=self.agent_worker,
+                                                    args=(agent, work),
+                                                    name='{} #{}'.format(agent, n + 1)))
+            if self.verbose:
+                printerr('Wave {}/{}: {} agent(s), {} site(s)'.format(i + 1,
+                                                                      len(waves),
+                                                                      len(wave),
+                                                                      total))
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        return(self.report(started))
+
+    def report(self, started):
+        agents = {}
+        for agent in self.agents:
+            inv = self.inventory.get(agent, {})
+            agents[agent] = {'hostname': inv.get('hostname'),
+                             'tags': inv.get('tags', []),
+                             'sites': len(inv.get('sites', [])),
+                             'error': inv.get('error'), }
+        failures = self.failures()
+        return({'started': started,
+                'finished': time.time(),
+                'tasks': self.tasks,
+                'agents': agents,
+                'results': self.results,
+                'summary': {'agents': len(self.agents),
+                            'agents_unreachable': len([a for a in agents.values()
+                                                       if a['error']]),
+                            'commands': len(self.results),
+                            'failures': len(failures), }, })
+
+
+def default_daemon_socket():
+    rundir = os.environ.get('XDG_RUNTIME_DIR')
+    if rundir:
+        return(os.path.join(rundir, 'wpupdater.sock'))
+    return('/tmp/wpupdater-{}.sock'.format(os.geteuid()))
+
+
+# Maintenance tasks in the order they are applied to each site, as
+# (name, DO_WP_Maintain method) pairs. Names are used on the wire by
+# the coordinator and agents.
+TASKS = (('core', 'update_core'),
+         ('db', 'update_db'),
+         ('plugins', 'update_plugins'),
+         ('themes', 'update_themes'),
+         ('transients', 'delete_expired_transients'),
+         ('optimize', 'optimize_database'),
+         ('custom', 'run_custom_cmds'), )
+
+
+def selected_tasks(args):
+    selected = []
+    if args.update_core or args.update_all or args.full:
+        selected.append('core')
+    if args.update_db or args.update_all or args.full:
+        selected.append('db')
+    if args.update_plugins or args.update_all or args.full:
+        selected.append('plugins')
+    if args.update_themes or args.update_all or args.full:
+        selected.append('themes')
+    if args.delete_expired_transients or args.full:
+        selected.append('transients')
+    if args.optimize_database:
+        selected.append('optimize')
+    if args.custom_cmds:
+        selected.append('custom')
+    return(selected)
+
+
+def run_task(dowp, task, sites=None, cmds=None):
+    method = getattr(dowp, dict(TASKS)[task])
+    if task == 'custom':
+        return(method(cmds, sites=sites))
+    return(method(sites=sites))
+
+
+def run_tasks(dowp, args, sites=None):
+    # Runs the maintenance tasks selected on the command line and returns
+    # the per-command results of all of them.
+    results = []
+    for task in selected_tasks(args):
+        results.extend(run_task(dowp, task, sites=sites,
+                                cmds=args.custom_cmds))
+    return(results)
+
+
+def add_task_arguments(parser):
     parser.add_argument('-C', '--update-core',
                         default=False,
                         action='store_true',
@@ -609,6 +2406,80 @@ DocumentRoots from.''')
                         action='store_true',
                         dest='full',
                         help='Updates all, and deletes expired transients. Does NOT optimize DB.')
+    parser.add_argument('--run',
+                        action='append',
+                        dest='custom_cmds',
+                        metavar='"WPCLI_COMMAND"',
+                        help='''Construct and run a wp-cli command on each wordpress instance.
+Necessary arguments will be automatically added.
+Example: --run="plugin install wp-fail2ban --activate"
+May be used multiple times; all commands run on a site before the next one.''')
+
+
+def run():
+    # TODO: ArgParse for droplet required tags
+    parser = argparse.ArgumentParser(description='''Tool that implements wp-cli
+maintenance tasks on servers that use Apache2, with a few useful features on
+DigitalOcean droplets.
+Future versions may support nginx/lighttpd.
+Author: Buanzo - https://www.github.com/buanzo''')
+    parser.add_argument('-t', '--tags',
+                        type=lambda arg: arg.split(','),
+                        action='append',
+                        default=None,
+                        dest='requiredtags',
+                        help='''Comma-separated list of required droplet tags.
+All tags must be assigned to droplet for maintenance to happen. May
+be used multiple times.''')
+    parser.add_argument('file',
+                        nargs='+',
+                        help='''Path to configuration files to extract
+DocumentRoots from.''')
+    parser.add_argument('--allow-root',
+                        default=False,
+                        action='store_true',
+                        dest='allow_root',
+                        help='Enables usage of this script as root. AVOID.')
+    add_task_arguments(parser)
+    parser.add_argument('--list-only',
+                        default=False,
+                        action='store_true',
+                        dest='list_only',
+                        help='List Wordpress installations that were found.')
+    parser.add_argument('--format',
+                        dest='list_format',
+                        choices=('table', 'json', 'csv'),
+                        default='table',
+                        help='Output format of --list-only. Defaults to table.')
+    parser.add_argument('--registry',
+                        dest='registry',
+                        default=None,
+                        metavar='FILE',
+                        help='''Keep discovered sites in FILE. When FILE exists, sites are loaded
+from it instead of being searched for and probed again.''')
+    parser.add_argument('--refresh-registry',
+                        default=False,
+                        action='store_true',
+                        dest='refresh_registry',
+                        help='Rediscover sites and rewrite --registry.')
+    parser.add_argument('--where',
+                        dest='where',
+                        type=parse_where,
+                        action='append',
+                        metavar='EXPR',
+                        help='''Only act on sites matching EXPR, e.g. "version<6.4" or
+"db_host=db1:3306". Fields: {}. May be used multiple times. Pre-releases
+sort below their release: 6.5-RC1 < 6.5.'''.format(', '.join(WHERE_FIELDS)))
+    parser.add_argument('--with-plugin',
+                        dest='with_plugins',
+                        action='append',
+                        metavar='SLUG',
+                        help='Only act on sites with plugin SLUG installed. May be used multiple times.')
+    parser.add_argument('--path-prefix',
+                        dest='path_prefixes',
+                        action='append',
+                        metavar='PREFIX',
+                        help='Only act on sites at or below directory PREFIX. May be used multiple times.')
     parser.add_argument('--hume',
                         action='store_true',
                         dest='hume',
@@ -648,23 +2519,122 @@ Multiple values separated by commas are NOT allowed''')
                         metavar='THEME_NAME',
                         help='''Skip updating the indicated theme. Can be specified multiple times.
 Multiple values separated by commas are NOT allowed''')
-    parser.add_argument('--run',
-                        action='append',
-                        dest='custom_cmds',
-                        metavar='"WPCLI_COMMAND"',
-                        help='''Construct and run a wp-cli command on each wordpress instance.
-Necessary arguments will be automatically added.
-Example: --run="plugin install wp-fail2ban --activate"''')
     parser.add_argument('--exec-timeout',
                         dest='exec_timeout',
                         metavar='"SECONDS"',
+                        type=int,
                         default=300,
-                        help='''Subprocess execution timeout. Defaults to 5m / 300s.''')
+                        help='''Subprocess execution timeout. Defaults to 5m / 300s.
+With --adaptive-timeouts, used until enough history exists.''')
+    parser.add_argument('--adaptive-timeouts',
+                        default=False,
+                        action='store_true',
+                        dest='adaptive_timeouts',
+                        help='''Derive per-site, per-command timeouts from durations recorded in
+previous runs (95th percentile x3, within --timeout-floor/--timeout-ceiling).
+Commands that change a site never get less than --exec-timeout.''')
+    parser.add_argument('--timing-db',
+                        dest='timing_db',
+                        metavar='PATH',
+                        default=default_timing_db(),
+                        help='''Where --adaptive-timeouts keeps command durations. Defaults to
+~/.cache/wpupdater/timings.json''')
+    parser.add_argument('--timeout-floor',
+                        dest='timeout_floor',
+                        metavar='SECONDS',
+                        type=int,
+                        default=30,
+                        help='Lowest adaptive timeout. Defaults to 30s.')
+    parser.add_argument('--timeout-ceiling',
+                        dest='timeout_ceiling',
+                        metavar='SECONDS',
+                        type=int,
+                        default=3600,
+                        help='Highest adaptive timeout. Defaults to 1h.')
+    parser.add_argument('--output-dir',
+                        dest='output_dir',
+                        default=None,
+                        metavar='DIR',
+                        help='''Stream the output of --run commands to DIR/<site>/<NNN>-<command>.out
+and .err instead of keeping it in memory.''')
+    parser.add_argument('--output-compress',
+                        default=False,
+                        action='store_true',
+                        dest='output_compress',
+                        help='Gzip the files written to --output-dir.')
+    parser.add_argument('--output-archive',
+                        dest='output_archive',
+                        default=None,
+                        metavar='FILE.zip',
+                        help='Stream the output of --run commands into a compressed zip archive.')
+    parser.add_argument('--trace',
+                        dest='trace',
+                        default=None,
+                        metavar='FILE',
+                        help='''Record a timeline of every phase and wp-cli call to FILE in Chrome
+trace-event format. Open it in https://ui.perfetto.dev''')
+    parser.add_argument('--profile',
+                        default=False,
+                        action='store_true',
+                        dest='profile',
+                        help='''With --trace, also sample Python stacks and write them as folded
+stacks (flamegraph input) next to the trace.''')
     parser.add_argument('--explicit-path',
                         default=False,
                         action='store_true',
                         dest='explicit_path',
                         help='Treat <file> argument as a Wordpress root dir, skip Apache Config')
+    parser.add_argument('--daemon',
+                        default=False,
+                        action='store_true',
+                        dest='daemon',
+                        help='''Keep running: watch configs and installs via inotify and run the
+selected tasks on a schedule. Accepts "list", "status" and "run" on a Unix socket.''')
+    parser.add_argument('--agent',
+                        default=None,
+                        dest='agent',
+                        metavar='HOST:PORT',
+                        help='''Serve as an agent for wpupdater-coordinator on HOST:PORT.
+Requires --agent-secret-file.''')
+    parser.add_argument('--agent-secret-file',
+                        default=None,
+                        dest='agent_secret_file',
+                        metavar='PATH',
+                        help='File holding the secret shared with the coordinator.')
+    parser.add_argument('--agent-tag',
+                        action='append',
+                        dest='agent_tags',
+                        metavar='TAG',
+                        help='Tag reported to the coordinator, used for staggering. May be used multiple times.')
+    parser.add_argument('--agent-allow-run',
+                        default=False,
+                        action='store_true',
+                        dest='agent_allow_run',
+                        help='Let the coordinator run custom wp-cli commands (--run) on this agent.')
+    parser.add_argument('--daemon-socket',
+                        dest='daemon_socket',
+                        metavar='PATH',
+                        default=default_daemon_socket(),
+                        help='''Unix socket for the daemon API. Defaults to
+$XDG_RUNTIME_DIR/wpupdater.sock or /tmp/wpupdater-UID.sock''')
+    parser.add_argument('--daemon-interval',
+                        dest='daemon_interval',
+                        metavar='SECONDS',
+                        type=int,
+                        default=86400,
+                        help='Seconds between scheduled maintenance runs. Defaults to 1 day.')
+    parser.add_argument('--daemon-new-site-delay',
+                        dest='daemon_new_site_delay',
+                        metavar='SECONDS',
+                        type=int,
+                        default=120,
+                        help='Maintain newly discovered sites after this many seconds. Defaults to 120.')
+    parser.add_argument('--daemon-rescan-interval',
+                        dest='daemon_rescan_interval',
+                        metavar='SECONDS',
+                        type=int,
+                        default=21600,
+                        help='Seconds between safety-net full rescans. Defaults to 6h.')
 
     # Now, parse the args
     args = parser.parse_args()
@@ -675,6 +2645,49 @@ Example: --run="plugin install wp-fail2ban --activate"''')
     else:
         args.requiredtags = None
 
+    # The daemon and agents work on a changing site list; a selection
+    # made once at startup would silently not apply to them.
+    if (args.where or args.with_plugins or args.path_prefixes) and \
+       (args.daemon or args.agent is not None):
+        parser.error('--where, --with-plugin and --path-prefix cannot be used with --daemon or --agent')
+
+    tracer = None
+    if args.profile and args.trace is None:
+        parser.error('--profile requires --trace')
+    # Traces are kept in memory and written at exit, which never comes
+    # for the long-running modes.
+    if args.trace is not None and (args.daemon or args.agent is not None):
+        parser.error('--trace and --profile cannot be used with --daemon or --agent')
+    if args.trace is not None:
+        tracer = Tracer(args.trace)
+        atexit.register(tracer.save)
+        if args.profile:
+            profiler = SamplingProfiler(profile_path(args.trace))
+            atexit.register(profiler.stop)  # runs before tracer.save
+            profiler.start()
+
+    timings = None
+    if args.adaptive_timeouts:
+        timings = CommandTimings(args.timing_db,
+                                 default=args.exec_timeout,
+                                 floor=args.timeout_floor,
+                                 ceiling=args.timeout_ceiling)
+
+    output_sink = None
+    if args.output_dir is not None and args.output_archive is not None:
+        parser.error('--output-dir and --output-archive are mutually exclusive')
+    try:
+        if args.output_dir is not None:
+            output_sink = DirectoryOutputSink(args.output_dir,
+                                              compress=args.output_compress)
+        elif args.output_archive is not None:
+            output_sink = ArchiveOutputSink(args.output_archive)
+    except OSError as exc:
+        printerr('Cannot set up command output: {}'.format(exc))
+        sys.exit(1)
+    if output_sink is not None:
+        atexit.register(output_sink.close)
+
     # IT HAS BEGUN!
     try:
         dowp = DO_WP_Maintain(requiredtags=args.requiredtags,
@@ -687,7 +2700,12 @@ Example: --run="plugin install wp-fail2ban --activate"''')
                               skip_plugins=args.skip_plugins,
                               skip_themes=args.skip_themes,
                               path_to_wpcli=args.path_to_wpcli,
-                              exec_timeout=args.exec_timeout)
+                              exec_timeout=args.exec_timeout,
+                              timings=timings,
+                              output_sink=output_sink,
+                              tracer=tracer,
+                              registry_path=args.registry,
+                              refresh_registry=args.refresh_registry)
     except Exception as exc:
         printerr(exc)
         sys.exit(1)
@@ -695,31 +2713,171 @@ Example: --run="plugin install wp-fail2ban --activate"''')
     if args.skip_wpcli_update is False:
         dowp.update_wpcli()
 
+    sites = None
+    if args.where or args.with_plugins or args.path_prefixes:
+        sites = dowp.wp_list.select(where=args.where or (),
+                                    plugins=args.with_plugins or (),
+                                    path_prefixes=args.path_prefixes or ())
+        if args.verbose:
+            printerr('{} of {} site(s) selected'.format(len(sites),
+                                                        len(dowp.wp_list)))
+
     if args.list_only is True:  # Just list
-        for wp in dowp.wp_list:
-            pprint(wp)  # TODO: pretty print
+        print(format_sites(dowp.wp_list if sites is None else sites,
+                           args.list_format))
+        dowp.save_state()
         sys.exit(0)
 
-    if args.update_core or args.update_all or args.full:
-        dowp.update_core()
+    if args.agent is not None:
+        if args.agent_secret_file is None:
+            printerr('--agent requires --agent-secret-file')
+            sys.exit(1)
+        try:
+            secret = read_fleet_secret(args.agent_secret_file)
+        except RuntimeError as exc:
+            printerr(exc)
+            sys.exit(1)
+        WPUpdaterAgent(dowp,
+                       args.agent,
+                       secret,
+                       tags=args.agent_tags,
+                       allow_run=args.agent_allow_run).serve()
+        sys.exit(0)
 
-    if args.update_db or args.update_all or args.full:
-        dowp.update_db()
+    if args.daemon:
+        if not selected_tasks(args):
+            printerr('No maintenance tasks selected; daemon will only keep the site list.')
+        daemon = WPUpdaterDaemon(dowp,
+                                 args,
+                                 socket_path=args.daemon_socket,
+                                 interval=args.daemon_interval,
+                                 new_site_delay=args.daemon_new_site_delay,
+                                 rescan_interval=args.daemon_rescan_interval)
+        try:
+            daemon.serve()
+        except RuntimeError as exc:
+            printerr(exc)
+            sys.exit(1)
+        sys.exit(0)
 
-    if args.update_plugins or args.update_all or args.full:
-        dowp.update_plugins()
+    run_tasks(dowp, args, sites=sites)
+    dowp.save_state()
+    dowp.report_overruns()
 
-    if args.update_themes or args.update_all or args.full:
-        dowp.update_themes()
 
-    if args.delete_expired_transients or args.full:
-        dowp.delete_expired_transients()
+def positive_int(arg):
+    if not arg.isdigit() or int(arg) < 1:
+        raise(argparse.ArgumentTypeError('expected a positive integer, got "{}"'.format(arg)))
+    return(int(arg))
 
-    if args.optimize_database:
-        dowp.optimize_database()
 
-    if args.custom_cmds:
-        dowp.run_custom_cmds(args.custom_cmds)
+def parse_task_limit(arg):
+    task, _, limit = arg.partition('=')
+    if task not in dict(TASKS) or not limit.isdigit() or int(limit) < 1:
+        raise(argparse.ArgumentTypeError('expected TASK=N with TASK one of {}'.format(', '.join(dict(TASKS)))))
+    return((task, int(limit)))
+
+
+def run_coordinator():
+    parser = argparse.ArgumentParser(description='''Coordinates wordpress
+maintenance across several servers running "wpupdater --agent", enforcing
+fleet-wide limits and collecting a single report.
+Author: Buanzo - https://www.github.com/buanzo''')
+    parser.add_argument('agents',
+                        nargs='+',
+                        metavar='AGENT',
+                        help='Agent address as HOST:PORT or http://HOST:PORT')
+    parser.add_argument('--secret-file',
+                        dest='secret_file',
+                        required=True,
+                        metavar='PATH',
+                        help='File holding the secret shared with the agents.')
+    add_task_arguments(parser)
+    parser.add_argument('--max-parallel',
+                        dest='max_parallel',
+                        type=positive_int,
+                        default=10,
+                        metavar='N',
+                        help='Sites maintained at once across the fleet. Defaults to 10.')
+    parser.add_argument('--per-agent',
+                        dest='per_agent',
+                        type=positive_int,
+                        default=2,
+                        metavar='N',
+                        help='Sites maintained at once on a single agent. Defaults to 2.')
+    parser.add_argument('--limit',
+                        dest='task_limits',
+                        type=parse_task_limit,
+                        action='append',
+                        metavar='TASK=N',
+                        help='''Fleet-wide concurrency limit for one task, e.g. --limit core=10.
+May be used multiple times.''')
+    parser.add_argument('--stagger',
+                        type=lambda arg: arg.split(','),
+                        default=None,
+                        metavar='TAG1,TAG2',
+                        help='''Run agents tagged TAG1 first, then TAG2, and so on. Remaining
+agents run last.''')
+    parser.add_argument('--stagger-pause',
+                        dest='stagger_pause',
+                        type=int,
+                        default=0,
+                        metavar='SECONDS',
+                        help='Pause between stagger waves.')
+    parser.add_argument('--stop-on-failure',
+                        default=False,
+                        action='store_true',
+                        dest='stop_on_failure',
+                        help='Do not start the next stagger wave if anything failed.')
+    parser.add_argument('--request-timeout',
+                        dest='request_timeout',
+                        type=positive_int,
+                        default=3600,
+                        metavar='SECONDS',
+                        help='Timeout for a single task on an agent. Defaults to 1h.')
+    parser.add_argument('--report',
+                        default=None,
+                        metavar='FILE',
+                        help='Write the JSON report to FILE instead of stdout.')
+    parser.add_argument('--version',
+                        action='version',
+                        version='WordpressUpdater {}'.format(str(__version__)))
+    parser.add_argument('-v', '--verbose',
+                        default=False,
+                        action='store_true',
+                        dest='verbose',
+                        help='Be more verbose.')
+    args = parser.parse_args()
+
+    tasks = selected_tasks(args)
+    if not tasks:
+        parser.error('no maintenance tasks selected')
+    try:
+        secret = read_fleet_secret(args.secret_file)
+    except RuntimeError as exc:
+        printerr(exc)
+        sys.exit(1)
+
+    coordinator = FleetCoordinator(args.agents,
+                                   secret,
+                                   tasks,
+                                   cmds=args.custom_cmds,
+                                   max_parallel=args.max_parallel,
+                                   per_agent=args.per_agent,
+                                   task_limits=dict(args.task_limits or []),
+                                   stagger=args.stagger,
+                                   stagger_pause=args.stagger_pause,
+                                   stop_on_failure=args.stop_on_failure,
+                                   request_timeout=args.request_timeout,
+                                   verbose=args.verbose)
+    report = coordinator.run()
+    if args.report is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    if report['summary']['failures'] or report['summary']['agents_unreachable']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':